@@ -0,0 +1,140 @@
+"""Running totals over all results, updated as results are added."""
+from __future__ import annotations
+
+from typing import Dict, Iterable, Optional
+
+import numpy #type: ignore
+
+from seat_typing import Result
+from match_store import MatchStore
+from weighted_stats import WeightedStats
+
+
+def _average(result: Result) -> float:
+    return result.duration / result.game_count
+
+
+class Bucket:
+    def __init__(self) -> None:
+        self.time = 0
+        self.games = 0
+
+    def add(self, result: Result) -> None:
+        self.time += result.duration
+        self.games += result.game_count
+
+    def merge(self, other: Bucket) -> None:
+        self.time += other.time
+        self.games += other.games
+
+
+class MatchAggregates: #pylint: disable=too-many-instance-attributes
+    def __init__(self) -> None:
+        self.match_count = 0
+        self.total = Bucket()
+        self.averages = WeightedStats()
+
+        self.divisions: Dict[str, Bucket] = {}
+        self.game_counts: Dict[int, Bucket] = {}
+
+        self.longest: Optional[Result] = None
+        self.shortest: Optional[Result] = None
+        self.longest_average: Optional[Result] = None
+        self.shortest_average: Optional[Result] = None
+
+    def add(self, result: Result) -> None:
+        self.match_count += 1
+        self.total.add(result)
+        self.averages.add(result.duration / result.game_count, result.game_count)
+
+        if result.division not in self.divisions:
+            self.divisions[result.division] = Bucket()
+        self.divisions[result.division].add(result)
+
+        if result.game_count not in self.game_counts:
+            self.game_counts[result.game_count] = Bucket()
+        self.game_counts[result.game_count].add(result)
+
+        self._extremes(result, result, result, result)
+
+    def _extremes(self, longest: Optional[Result], shortest: Optional[Result],
+            longest_average: Optional[Result], shortest_average: Optional[Result]) -> None:
+        # strict comparisons keep the earliest result on ties, like max()/min()
+        if longest is not None and (self.longest is None
+                or longest.duration > self.longest.duration):
+            self.longest = longest
+        if shortest is not None and (self.shortest is None
+                or shortest.duration < self.shortest.duration):
+            self.shortest = shortest
+        if longest_average is not None and (self.longest_average is None
+                or _average(longest_average) > _average(self.longest_average)):
+            self.longest_average = longest_average
+        if shortest_average is not None and (self.shortest_average is None
+                or _average(shortest_average) < _average(self.shortest_average)):
+            self.shortest_average = shortest_average
+
+    def extend(self, results: Iterable[Result]) -> None:
+        for result in results:
+            self.add(result)
+
+    def merge(self, other: MatchAggregates) -> None:
+        """Add the totals of other, e.g. of another shard, as if its results
+        had been added after these."""
+        self.match_count += other.match_count
+        self.total.merge(other.total)
+        self.averages.merge(other.averages)
+        for buckets, other_buckets in ((self.divisions, other.divisions),
+                (self.game_counts, other.game_counts)):
+            for key, bucket in other_buckets.items():
+                buckets.setdefault(key, Bucket()).merge(bucket) # type: ignore
+        self._extremes(other.longest, other.shortest,
+                other.longest_average, other.shortest_average)
+
+    @classmethod
+    def combine(cls, parts: Iterable[MatchAggregates]) -> MatchAggregates:
+        aggregates = cls()
+        for part in parts:
+            aggregates.merge(part)
+        return aggregates
+
+    def tier(self, tier: str) -> Bucket:
+        bucket = Bucket()
+        for division, division_bucket in self.divisions.items():
+            if tier in division:
+                bucket.time += division_bucket.time
+                bucket.games += division_bucket.games
+        return bucket
+
+    @classmethod
+    def from_store(cls, store: MatchStore) -> MatchAggregates:
+        """The same totals computed in bulk from a columnar store."""
+        aggregates = cls()
+        if not len(store): # pylint: disable=use-implicit-booleaness-not-len
+            return aggregates
+
+        durations = store.duration
+        game_counts = store.game_count
+        averages = durations / game_counts
+
+        aggregates.match_count = len(store)
+        aggregates.total.time = int(durations.sum())
+        aggregates.total.games = int(game_counts.sum())
+        aggregates.averages = WeightedStats.from_sums(aggregates.total.games,
+                aggregates.total.time, float((durations * averages).sum()))
+
+        for keys, names, buckets in (
+                (store.division, store.divisions, aggregates.divisions),
+                (game_counts, None, aggregates.game_counts)):
+            times = numpy.bincount(keys, weights=durations)
+            games = numpy.bincount(keys, weights=game_counts)
+            for key in numpy.flatnonzero(numpy.bincount(keys)):
+                bucket = Bucket()
+                bucket.time = int(times[key])
+                bucket.games = int(games[key])
+                buckets[names[key] if names is not None else int(key)] = bucket
+
+        aggregates.longest = store.result(int(durations.argmax()))
+        aggregates.shortest = store.result(int(durations.argmin()))
+        aggregates.longest_average = store.result(int(averages.argmax()))
+        aggregates.shortest_average = store.result(int(averages.argmin()))
+        return aggregates
@@ -0,0 +1,85 @@
+"""Recorded #matches/#results messages, and stand-ins for discord.Message
+that the parse functions accept in place of the real thing.
+
+An archive is JSON lines, one message per line:
+    {"id": 1, "channel": "results", "guild": 2, "author": "League Results#0000",
+     "created_at": "2021-03-01T19:03:12.345000",
+     "embeds": [{"title": "...", "fields": [{"name": "...", "value": "..."}]}]}
+"""
+import datetime
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+
+@dataclass
+class ArchivedField:
+    name: str
+    value: str = ''
+
+
+@dataclass
+class ArchivedEmbed:
+    title: str
+    fields: List[ArchivedField] = field(default_factory=list)
+
+
+@dataclass
+class ArchivedChannel:
+    name: str
+    id: int = 0 #pylint: disable=invalid-name
+
+
+@dataclass
+class ArchivedGuild:
+    id: int #pylint: disable=invalid-name
+
+
+@dataclass
+class ArchivedMessage:
+    """Just the parts of discord.Message that the parse functions use."""
+    id: int #pylint: disable=invalid-name
+    channel: ArchivedChannel
+    author: str
+    created_at: datetime.datetime
+    embeds: List[ArchivedEmbed]
+    # archives recorded before sharding have no guild
+    guild: Optional[ArchivedGuild] = None
+
+
+def message_to_record(message: Any) -> Dict[str, Any]:
+    return {
+        'id': message.id,
+        'channel': message.channel.name,
+        'guild': None if message.guild is None else message.guild.id,
+        'author': str(message.author),
+        'created_at': message.created_at.isoformat(),
+        'embeds': [{'title': embed.title,
+                    'fields': [{'name': f.name, 'value': f.value} for f in embed.fields]}
+                   for embed in message.embeds],
+    }
+
+def record_to_message(record: Dict[str, Any]) -> ArchivedMessage:
+    return ArchivedMessage(
+            record['id'],
+            ArchivedChannel(record['channel']),
+            record['author'],
+            datetime.datetime.fromisoformat(record['created_at']),
+            [ArchivedEmbed(embed['title'],
+                [ArchivedField(f['name'], f['value']) for f in embed['fields']])
+                for embed in record['embeds']],
+            None if record.get('guild') is None else ArchivedGuild(record['guild']))
+
+def read_archive(filename: str) -> Iterator[ArchivedMessage]:
+    with open(filename, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield record_to_message(json.loads(line))
+
+def write_archive(filename: str, messages: Iterable[Any]) -> int:
+    written = 0
+    with open(filename, 'a', encoding='utf-8') as file:
+        for message in messages:
+            file.write(json.dumps(message_to_record(message)) + '\n')
+            written += 1
+    return written
@@ -0,0 +1,196 @@
+#!env/bin/python3
+"""Time ingestion, persistence and statistics on synthetic league data.
+
+Usage: benchmark.py [--sizes 1000,10000,100000] [--output benchmark.json]
+
+Results are written as JSON so runs on different commits can be compared.
+Besides timings it records the memory taken by the Result objects, and how
+long a fresh interpreter takes to import the bot.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from typing import Any, Callable, Dict, List, Tuple
+
+import matplotlib # type: ignore
+matplotlib.use('Agg')
+from matplotlib import pyplot # pylint: disable=wrong-import-position
+
+import game_statistics # pylint: disable=wrong-import-position
+from database import Database # pylint: disable=wrong-import-position
+
+# (players, start, end, game count, division)
+SyntheticMatch = Tuple[Tuple[str, str], datetime.datetime, datetime.datetime, int, str]
+
+def generate_league(matches: int, #pylint: disable=too-many-arguments,too-many-locals
+        players: int = 400,
+        seasons: int = 10,
+        divisions: int = 8,
+        density: float = 6.0,
+        seed: int = 0) -> List[SyntheticMatch]:
+    """Matches spread evenly over the seasons, `density` matches per hour on
+    average, between players of the same division. Each player has their own
+    typical game length."""
+    rnd = random.Random(seed)
+    names = [f'Player {i}' for i in range(players)]
+    tempo = {name: rnd.uniform(900, 2400) for name in names}
+    division_names = [chr(ord('A') + i % 10) + str(1 + i // 10) for i in range(divisions)]
+
+    league: List[SyntheticMatch] = []
+    time_now = datetime.datetime(2020, 1, 1)
+    per_season = max(matches // seasons, 1)
+    for index in range(matches):
+        if index % per_season == 0:
+            # new season: reshuffle the divisions and take a break
+            rnd.shuffle(names)
+            time_now += datetime.timedelta(days=14)
+        time_now += datetime.timedelta(hours=rnd.expovariate(density))
+
+        division = rnd.randrange(divisions)
+        members = names[division::divisions]
+        pair = tuple(rnd.sample(members, 2))
+        games = rnd.randint(1, 6)
+        game_length = (tempo[pair[0]] + tempo[pair[1]]) / 2 * rnd.uniform(0.7, 1.4)
+        end = time_now + datetime.timedelta(seconds=games * game_length)
+        league.append((pair, time_now, end, games, division_names[division])) # type: ignore
+    return league
+
+def _timed(function: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    return time.perf_counter() - start
+
+def ingest(database: Database, league: List[SyntheticMatch]) -> Tuple[float, float]:
+    """Feed matches and results in time order, like the bot would see them.
+    Returns the time spent in add_match and in add_results."""
+    events = [(start, 0, i) for i, (_, start, _, _, _) in enumerate(league)]
+    events += [(end, 1, i) for i, (_, _, end, _, _) in enumerate(league)]
+    events.sort()
+
+    match_time, result_time = 0.0, 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, is_result, i in events:
+            players, start, end, games, division = league[i]
+            before = time.perf_counter()
+            if is_result:
+                database.add_results(players, end, games, division)
+                result_time += time.perf_counter() - before
+            else:
+                database.add_match(players, start)
+                match_time += time.perf_counter() - before
+    return match_time, result_time
+
+def result_memory(database: Database) -> Dict[str, float]:
+    """Bytes allocated per Result when loading all of them, including the
+    list slot, and the size of the instance itself."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = database.store.results()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {
+        'bytes_per_result': allocated / max(len(results), 1),
+        'instance_bytes': sys.getsizeof(results[0]) if results else 0,
+    }
+
+def run_size(size: int) -> Tuple[Dict[str, float], Dict[str, float]]:
+    league = generate_league(size)
+    directory = tempfile.mkdtemp(prefix='dominion_benchmark_')
+    database = Database(directory)
+
+    timings: Dict[str, float] = {}
+    timings['add_match'], timings['add_results'] = ingest(database, league)
+    timings['save'] = _timed(database.save)
+
+    loaded = Database(directory)
+    timings['load'] = _timed(loaded.load)
+    timings['export_matches'] = _timed(
+            lambda: database.export_matches(f'{directory}/matches.csv'))
+
+    busiest = database.registry.name(max(database.player_matches,
+        key=lambda p: len(database.player_matches[p])))
+    timings['main'] = _timed(lambda: game_statistics.main(database))
+    timings['big_stats'] = _timed(lambda: game_statistics.big_stats(database))
+    timings['player_stats'] = _timed(lambda: game_statistics.player_stats(busiest, database))
+    with warnings.catch_warnings():
+        # show() is a no-op with the Agg backend
+        warnings.simplefilter('ignore')
+        timings['big_correlation'] = _timed(lambda: game_statistics.big_correlation(database))
+    pyplot.close('all')
+    return timings, result_memory(loaded)
+
+# cumulative import times recorded by startup_imports, if they're imported
+STARTUP_MODULES = ('discord_bot', 'discord_commands', 'discord', 'game_statistics',
+        'database', 'numpy', 'matplotlib.pyplot')
+
+def startup_imports(module: str = 'discord_bot', runs: int = 3) -> Dict[str, float]:
+    """Seconds spent importing module and its heavy dependencies, per
+    python -X importtime, fastest of a few runs."""
+    best: Dict[str, float] = {}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+        times: Dict[str, float] = {}
+        for line in output.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            _, cumulative, name = line.split('|')
+            if name.strip() in STARTUP_MODULES and cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1e6
+        for name, seconds in times.items():
+            best[name] = min(best.get(name, seconds), seconds)
+    return best
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+            help='comma separated match counts')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'sizes': {},
+        'memory': {},
+        'startup': startup_imports(),
+    }
+    for name, seconds in results['startup'].items():
+        print(f'import {name:22} {seconds*1000:10.1f}ms')
+    for size in (int(x) for x in args.sizes.split(',')):
+        timings, memory = run_size(size)
+        results['sizes'][str(size)] = timings
+        results['memory'][str(size)] = memory
+        print(f'{size} matches')
+        for name, seconds in timings.items():
+            print(f'\t{name:16} {seconds*1000:10.1f}ms')
+        for name, size_bytes in memory.items():
+            print(f'\t{name:16} {size_bytes:10.1f}B')
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    _main()
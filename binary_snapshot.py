@@ -0,0 +1,123 @@
+"""Fixed-width binary snapshot of all results, read back with numpy.memmap.
+
+Layout, all little endian:
+    header      magic, format version, record count, and the byte lengths
+                of the two name tables
+    players     player names, utf-8, newline separated, in player id order
+    divisions   division names in the same format
+    records     RECORD_DTYPE structs, starting at an 8 byte aligned offset
+"""
+import os
+import struct
+from typing import List, Tuple
+
+import numpy #type: ignore
+
+from seat_typing import Result
+from player_registry import PlayerRegistry
+from match_store import MatchStore
+from aggregates import MatchAggregates
+from cache import LRUCache
+
+MAGIC = b'DGLS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQII')
+
+RECORD_DTYPE = numpy.dtype([
+    ('start_time', '<i8'),
+    ('duration', '<i8'),
+    ('game_count', '<i4'),
+    ('division', '<i4'),
+    ('player_a', '<i4'),
+    ('player_b', '<i4'),
+])
+
+def _encode_names(names: List[str]) -> bytes:
+    return '\n'.join(names).encode('utf-8')
+
+def _decode_names(data: bytes) -> List[str]:
+    return data.decode('utf-8').split('\n') if data else []
+
+def _records_offset(players_length: int, divisions_length: int) -> int:
+    offset = HEADER.size + players_length + divisions_length
+    return (offset + 7) // 8 * 8
+
+def write_snapshot(store: MatchStore, path: str) -> None:
+    players = _encode_names(store.players)
+    divisions = _encode_names(store.divisions)
+
+    records = numpy.empty(len(store), dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE.names:
+        records[name] = getattr(store, name)
+
+    offset = _records_offset(len(players), len(divisions))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(records),
+            len(players), len(divisions)))
+        file.write(players)
+        file.write(divisions)
+        file.write(b'\0' * (offset - file.tell()))
+        records.tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+def read_snapshot(path: str) -> MatchStore:
+    """Open a snapshot as a MatchStore whose columns are read-only views of
+    the memory mapped file. Appending to it copies the columns into memory."""
+    with open(path, 'rb') as file:
+        magic, version, count, players_length, divisions_length = HEADER.unpack(
+                file.read(HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} match snapshot')
+        players = _decode_names(file.read(players_length))
+        divisions = _decode_names(file.read(divisions_length))
+
+    offset = _records_offset(players_length, divisions_length)
+    if count:
+        records = numpy.memmap(path, dtype=RECORD_DTYPE, mode='r',
+                offset=offset, shape=(count,))
+    else:
+        records = numpy.empty(0, dtype=RECORD_DTYPE)
+    columns = {name: records[name] for name in RECORD_DTYPE.names}
+    return MatchStore.from_columns(columns, players, divisions)
+
+
+class SnapshotDatabase:
+    """Read-only stand-in for Database over a binary snapshot, enough for
+    game_statistics. Result objects are only created for the matches a
+    query returns."""
+    def __init__(self, path: str):
+        self.store = read_snapshot(path)
+        # without aliases, players are asked for by the name they're stored under
+        self.registry = PlayerRegistry()
+        self.version = 0
+        # (player, version) -> average game length
+        self.averages: LRUCache[Tuple[str, int], float] = LRUCache(maxsize=1024)
+        self._aggregates = None
+
+    def _player_rows(self, player: str) -> numpy.ndarray:
+        player_id = self.store.player_ids.get(self.registry.canonical(player))
+        if player_id is None:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.flatnonzero((self.store.player_a == player_id)
+                | (self.store.player_b == player_id))
+
+    def matches_for(self, player: str) -> List[Result]:
+        return [self.store.result(i) for i in self._player_rows(player)]
+
+    def player_totals(self, player: str) -> Tuple[int, int]:
+        rows = self._player_rows(player)
+        return (int(self.store.duration[rows].sum()),
+                int(self.store.game_count[rows].sum()))
+
+    @property
+    def aggregates(self) -> MatchAggregates:
+        if self._aggregates is None:
+            self._aggregates = MatchAggregates.from_store(self.store)
+        return self._aggregates
+
+    @property
+    def flat_matches(self) -> List[Result]:
+        return self.store.results()
@@ -0,0 +1,117 @@
+"""Size-bounded least recently used caches."""
+import collections
+import typing
+from typing import Dict, Generic, Hashable, Iterable, List, Optional, Set, TypeVar
+
+KeyT = TypeVar('KeyT', bound=Hashable)
+ValueT = TypeVar('ValueT')
+
+
+class LRUCache(Generic[KeyT, ValueT]):
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: typing.OrderedDict[KeyT, ValueT] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: KeyT) -> bool:
+        return key in self._entries
+
+    def get(self, key: KeyT, default: Optional[ValueT] = None) -> Optional[ValueT]:
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: KeyT, value: ValueT) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: KeyT) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class ReportCache:
+    """LRU cache of rendered reports that each depend on a set of players.
+
+    Adding a result for a player drops every report depending on them. Those
+    reports are remembered as stale, so they can be recomputed before anyone
+    asks for them again."""
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._reports: LRUCache[str, str] = LRUCache(maxsize)
+        self._dependents: Dict[str, Set[str]] = {}
+        self._stale: typing.OrderedDict[str, None] = collections.OrderedDict()
+
+        # lets put() tell whether a report computed since token() is outdated
+        self._generation = 0
+        self._invalidated_at: Dict[str, int] = {}
+        self._cleared_at = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._reports)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._reports
+
+    def get(self, key: str) -> Optional[str]:
+        report = self._reports.get(key)
+        if report is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return report
+
+    def token(self) -> int:
+        """Take before computing a report, and pass to put()."""
+        return self._generation
+
+    def put(self, key: str, report: str, depends_on: Iterable[str],
+            token: Optional[int] = None) -> bool:
+        """Cache report, unless one of the players it depends on has had a
+        result added since token was taken. Returns whether it was cached."""
+        depends_on = set(depends_on)
+        if token is not None and (self._cleared_at > token or any(
+                self._invalidated_at.get(player, -1) > token for player in depends_on)):
+            return False
+        self._reports.put(key, report)
+        self._stale.pop(key, None)
+        for player in depends_on:
+            self._dependents.setdefault(player, set()).add(key)
+        return True
+
+    def invalidate(self, players: Iterable[str]) -> None:
+        self._generation += 1
+        for player in players:
+            self._invalidated_at[player] = self._generation
+            for key in self._dependents.pop(player, ()):
+                if key in self._reports:
+                    self._reports.discard(key)
+                    self._stale[key] = None
+                    self._stale.move_to_end(key)
+        while len(self._stale) > self.maxsize:
+            self._stale.popitem(last=False)
+
+    def take_stale(self) -> List[str]:
+        """Keys of the reports invalidated since the last call, most recently
+        invalidated first."""
+        stale = list(reversed(self._stale))
+        self._stale.clear()
+        return stale
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._cleared_at = self._generation
+        self._reports.clear()
+        self._dependents = {}
+        self._stale.clear()
+        self._invalidated_at = {}
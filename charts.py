@@ -0,0 +1,103 @@
+"""Charts of the statistics rendered to PNG for !chart.
+
+They're drawn on a plain Figure with the Agg canvas, which doesn't need a
+display or pyplot's global state, so they can be rendered in the stats pool.
+matplotlib is only imported when a chart is drawn.
+"""
+import io
+from typing import Any, Callable, Dict, List
+
+import numpy #type: ignore
+
+import game_statistics
+
+CHART_SIZE = (8, 5)
+DPI = 100
+ROLLING_MATCHES = 10
+
+
+def _figure() -> Any:
+    # pylint: disable=import-outside-toplevel
+    from matplotlib.figure import Figure # type: ignore
+    from matplotlib.backends.backend_agg import FigureCanvasAgg # type: ignore
+    figure = Figure(figsize=CHART_SIZE, dpi=DPI)
+    FigureCanvasAgg(figure)
+    return figure
+
+def _png(figure: Any) -> bytes:
+    buffer = io.BytesIO()
+    figure.tight_layout()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def correlation_chart(database: Any, _argument: str = '') -> bytes:
+    figure = _figure()
+    game_statistics.draw_correlation(figure.subplots(), database)
+    return _png(figure)
+
+def player_chart(database: Any, player: str) -> bytes:
+    """Average game length of each of the player's matches over time, and of
+    their last ROLLING_MATCHES matches. Raises ValueError for unknown players."""
+    store = database.store
+    player_id = store.player_ids.get(player, -1)
+    rows = numpy.flatnonzero((store.player_a == player_id) | (store.player_b == player_id))
+    if not len(rows): #pylint: disable=use-implicit-booleaness-not-len
+        raise ValueError(f'no matches recorded for {player}')
+    rows = rows[numpy.argsort(store.start_time[rows], kind='stable')]
+
+    times = store.start_time[rows].astype('datetime64[s]')
+    durations = store.duration[rows]
+    games = store.game_count[rows]
+
+    # weighted by games like the averages in the reports
+    total_time = numpy.cumsum(durations)
+    total_games = numpy.cumsum(games)
+    window = min(ROLLING_MATCHES, len(rows))
+    rolling = ((total_time[window-1:] - numpy.concatenate(([0], total_time[:-window])))
+            / (total_games[window-1:] - numpy.concatenate(([0], total_games[:-window]))))
+
+    figure = _figure()
+    axes = figure.subplots()
+    axes.scatter(times, durations / games, s=12, c='000000', label='match')
+    axes.plot(times[window-1:], rolling, label=f'last {window} matches')
+    axes.set_title(f'Average game length of {player}. n={len(rows)}')
+    axes.set_ylabel('average game duration in the match')
+    axes.legend()
+    figure.autofmt_xdate()
+    return _png(figure)
+
+def division_chart(database: Any, tier: str = '') -> bytes:
+    """Distribution of the average game length of matches in each division,
+    only of divisions whose name contains tier if it's given."""
+    store = database.store
+    averages = store.duration / store.game_count
+    labels: List[str] = []
+    distributions: List[numpy.ndarray] = []
+    for division_id in sorted(store.divisions_containing(tier),
+            key=lambda x: store.divisions[x]):
+        division_averages = averages[store.division == division_id]
+        if len(division_averages): #pylint: disable=use-implicit-booleaness-not-len
+            labels.append(store.divisions[division_id])
+            distributions.append(division_averages)
+    if not distributions:
+        raise ValueError(f'no matches recorded in divisions matching {tier}'
+                if tier else 'no matches recorded')
+
+    figure = _figure()
+    axes = figure.subplots()
+    axes.boxplot(distributions, showfliers=False)
+    axes.set_xticks(range(1, len(labels) + 1), labels, rotation=90)
+    axes.set_title('Average game length of matches per division')
+    axes.set_ylabel('average game duration in the match')
+    return _png(figure)
+
+CHARTS: Dict[str, Callable[[Any, str], bytes]] = {
+        'correlation': correlation_chart,
+        'player': player_chart,
+        'divisions': division_chart,
+        }
+
+def render(kind: str, argument: str, database: Any) -> bytes:
+    """PNG of the chart kind. Raises ValueError if there's nothing to draw."""
+    return CHARTS[kind](database, argument)
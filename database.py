@@ -1,44 +1,140 @@
+import bisect
 import datetime
+import heapq
 import pickle
+import os
 import os.path
-from typing import List, Dict
-from seat_typing import Result, Players
+import typing
+from typing import List, Dict, Optional, Tuple
+from seat_typing import Result, Players, from_epoch, to_epoch
+from player_registry import PlayerIds, PlayerRegistry
+from match_store import MatchStore
+from binary_snapshot import read_snapshot, write_snapshot
+from export import ExportFilter, export_csv
+from cache import LRUCache, ReportCache
+from aggregates import MatchAggregates
+from journal import Journal, Record
+from sharded_database import ShardedDatabase
+import perf
 
+ADJACENT_WINDOW = datetime.timedelta(minutes=10)
+ADJACENT_SECONDS = int(ADJACENT_WINDOW.total_seconds())
+MATCH_WINDOW = datetime.timedelta(hours=6)
 
+SNAPSHOT_FILE = 'snapshot.pickle'
+RESULTS_FILE = 'results.snapshot'
+JOURNAL_FILE = 'journal.jsonl'
+COMPACT_EVERY = 5000
 
-class Database:
-    def __init__(self):
-        self.pending_matches: Dict[Players, List[datetime.datetime]] = {}
+def _fsync_directory(directory: str) -> None:
+    file = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(file)
+    finally:
+        os.close(file)
 
-        self.matches: Dict[Players, List[Result]] = {}
+def _has_adjacent(times: List[typing.Any],
+        time: typing.Any,
+        window: typing.Any) -> bool:
+    """Whether the sorted list `times` has an entry less than `window` from `time`."""
+    index = bisect.bisect_right(times, time - window)
+    return index < len(times) and times[index] - time < window
+
+
+class Database: #pylint: disable=too-many-instance-attributes
+    def __init__(self, directory: str = '.', journaling: bool = True):
+        """Without journaling changes are only persisted by save."""
+        self.directory = directory
+        self.journal = Journal(self._path(JOURNAL_FILE))
+        self.journaling = journaling
+        self._replaying = False
+
+        # the aliases of this shard's players
+        self.registry = PlayerRegistry()
+
+        # both kept sorted by start time
+        # keyed by the registry ids of the pair of players
+        self.pending_matches: Dict[PlayerIds, List[datetime.datetime]] = {}
+        # (deadline, start, pair), a pending match can't be paired once
+        # a result past its deadline has been added
+        self._pending_expiry: List[Tuple[datetime.datetime, datetime.datetime, PlayerIds]] = []
+        # end of the latest result added, only ever moves forward
+        self.latest_result: Optional[datetime.datetime] = None
+
+        self.matches: Dict[PlayerIds, List[Result]] = {}
+        # start epochs, like Result.start_epoch
+        self.match_times: Dict[PlayerIds, List[int]] = {}
 
         self.flat_matches : List[Result]= []
 
+        self.player_matches: Dict[int, List[Result]] = {}
+
+        # channel id -> id of the newest message !update has parsed there
+        self.checkpoints: Dict[int, int] = {}
+
+        self.store = MatchStore()
+        self.aggregates = MatchAggregates()
+
+        # bumped whenever the set of results changes
+        self.version = 0
+        # (player, version) -> average game length
+        self.averages: LRUCache[Tuple[str, int], float] = LRUCache(maxsize=1024)
+        # rendered !player reports
+        self.reports = ReportCache()
+
+    @perf.timed('database.add_match')
     def add_match(self, players: Players,
             start: datetime.datetime,
             verbose: bool = False) -> bool:
 
-        players = tuple(sorted(p.lower() for p in players)) #type: ignore
-
-        if players in self.matches:
-            for match in self.matches[players]:
-                if abs(match.start_time - start) < datetime.timedelta(minutes=10):
-                    if verbose:
-                        print('adjacent match')
-                    return False
-
-        if players in self.pending_matches:
-            for pending_match in self.pending_matches[players]:
-                if abs(pending_match - start) < datetime.timedelta(minutes=10):
-                    if verbose:
-                        print('adjacent pending match')
-                    return False
-            self.pending_matches[players].append(start)
+        self._maybe_compact()
+        pair = self.registry.pair(players)
+        players = self.registry.pair_names(pair)
+
+        if pair in self.match_times:
+            if _has_adjacent(self.match_times[pair], to_epoch(start), ADJACENT_SECONDS):
+                if verbose:
+                    print('adjacent match')
+                return False
+
+        if pair in self.pending_matches:
+            if _has_adjacent(self.pending_matches[pair], start, ADJACENT_WINDOW):
+                if verbose:
+                    print('adjacent pending match')
+                return False
+            bisect.insort(self.pending_matches[pair], start)
         else:
-            self.pending_matches[players] = [start]
+            self.pending_matches[pair] = [start]
+        heapq.heappush(self._pending_expiry, (self._deadline(start), start, pair))
+        self._log({'op': 'match', 'players': players, 'start': start.isoformat()})
 
         return True
 
+    def _deadline(self, start: datetime.datetime) -> datetime.datetime:
+        # a backfilled match gets a full window from the latest result, so
+        # it isn't dropped before its own result has had a chance to arrive
+        if self.latest_result is not None and self.latest_result > start:
+            return self.latest_result + MATCH_WINDOW
+        return start + MATCH_WINDOW
+
+    def expire_pending(self, now: datetime.datetime) -> int:
+        """Drop pending matches whose deadline has passed at `now`."""
+        expired = 0
+        while self._pending_expiry and self._pending_expiry[0][0] < now:
+            _, start, pair = heapq.heappop(self._pending_expiry)
+            pending = self.pending_matches.get(pair)
+            if not pending:
+                continue
+            # entries already paired with a result are left in the heap
+            index = bisect.bisect_left(pending, start)
+            if index < len(pending) and pending[index] == start:
+                del pending[index]
+                expired += 1
+                if not pending:
+                    del self.pending_matches[pair]
+        return expired
+
+    @perf.timed('database.add_results')
     def add_results(self, #pylint: disable=too-many-arguments
             players: Players,
             end: datetime.datetime,
@@ -46,87 +142,301 @@ class Database:
             division: str,
             verbose: bool = False) -> bool:
 
-        players = tuple(sorted(p.lower() for p in players)) #type: ignore
+        self._maybe_compact()
+        pair = self.registry.pair(players)
+        players = self.registry.pair_names(pair)
 
-        if players not in self.pending_matches or not self.pending_matches[players]:
+        if pair not in self.pending_matches or not self.pending_matches[pair]:
             if verbose:
                 print(f"No pending match between {players}")
             return False
 
-        pending_matches = [match for match in self.pending_matches[players]
-            if end - match < datetime.timedelta(hours=6) and end > match]
-
-        if not pending_matches:
+        pending_matches = self.pending_matches[pair]
+        index = bisect.bisect_left(pending_matches, end) - 1
+        if index < 0 or end - pending_matches[index] >= MATCH_WINDOW:
             print(f'Found no suitable pending matches between {players}')
             return False
 
-        pending_matches.sort(reverse=True)
-
-        start_time = pending_matches[0]
-        self.pending_matches[players].remove(start_time)
+        start_time = pending_matches.pop(index)
+        self._log({'op': 'result', 'players': players, 'end': end.isoformat(),
+            'games': games, 'division': division})
 
         delta = end - start_time
         duration = int(delta.total_seconds())
 
-        if players not in self.matches:
-            self.matches[players] = []
-        else:
-            for match in self.matches[players]:
-                if abs(match.start_time - start_time) < datetime.timedelta(minutes=10):
-                    print(f'About to add duplicate match between {players} at {start_time}!')
-                    return False
+        if pair not in self.matches:
+            self.matches[pair] = []
+            self.match_times[pair] = []
+        elif _has_adjacent(self.match_times[pair], to_epoch(start_time), ADJACENT_SECONDS):
+            print(f'About to add duplicate match between {players} at {start_time}!')
+            return False
 
         avg = duration/games
         if avg < 300 or avg > 7200:
             print(f'Extreme average {avg} in {games}, skipping match between {players}')
 
-        result = Result(players, start_time, duration, games, division)
-        self.matches[players].append(result)
+        result = Result(pair, start_time, duration, games, division)
+        index = bisect.bisect(self.match_times[pair], result.start_epoch)
+        self.match_times[pair].insert(index, result.start_epoch)
+        self.matches[pair].insert(index, result)
         self.flat_matches.append(result)
+        self._index_result(result)
+        self.store.append(result)
+        self.aggregates.add(result)
+        self.version += 1
+        # only successful results move the clock, so a rejected or
+        # out-of-order result can't drop pending matches early
+        if self.latest_result is None or end > self.latest_result:
+            self.latest_result = end
+            self.expire_pending(end)
+        self.reports.invalidate(players)
         if verbose:
             print(f'Added match between {players}')
         return True
 
+    def _index_result(self, result: Result) -> None:
+        for player in result.player_ids:
+            if player not in self.player_matches:
+                self.player_matches[player] = [result]
+            else:
+                self.player_matches[player].append(result)
+
+    def checkpoint(self, channel_id: int, message_id: int) -> None:
+        """Record that all messages in a channel up to message_id are parsed.
+        Checkpoints only move forward."""
+        if message_id <= self.checkpoints.get(channel_id, 0):
+            return
+        self.checkpoints[channel_id] = message_id
+        self._log({'op': 'checkpoint', 'channel': channel_id, 'message': message_id})
+
+    def add_alias(self, alias: str, name: str) -> None:
+        """Record alias as another name of the player called name, e.g. after
+        a rename. The matches already played as alias are counted as name's.
+        Raises ValueError if alias is already an alias of a different player."""
+        merges = self.registry.merges(alias, name)
+        self.registry.add_alias(alias, name)
+        self._log({'op': 'alias', 'alias': alias, 'name': name})
+        if merges:
+            self.remap_players()
+        self.averages.clear()
+        self.reports.clear()
+
+    def remap_players(self) -> None:
+        """Re-key the results and pending matches by the players' current
+        ids, after add_alias merged two players."""
+        for result in self.flat_matches:
+            result.player_ids = self.registry.pair(result.players)
+        self._set_pending({self.registry.pair_names(pair): pending
+            for pair, pending in self.pending_matches.items()})
+        # the deadlines stay as they were, only the pairs are re-keyed
+        self._pending_expiry = [
+            (deadline, start, self.registry.pair(self.registry.pair_names(pair)))
+            for deadline, start, pair in self._pending_expiry]
+        heapq.heapify(self._pending_expiry)
+        self._set_matches()
+        self._rebuild_index()
+
+    def _rebuild_pending(self) -> None:
+        self._pending_expiry = []
+        for pair, pending in self.pending_matches.items():
+            pending.sort()
+            self._pending_expiry.extend(
+                (self._deadline(start), start, pair) for start in pending)
+        heapq.heapify(self._pending_expiry)
+
+    def _rebuild_index(self, store: Optional[MatchStore] = None) -> None:
+        self.match_times = {}
+        for pair, results in self.matches.items():
+            results.sort(key=lambda x: x.start_epoch)
+            self.match_times[pair] = [x.start_epoch for x in results]
+        self.player_matches = {}
+        for result in self.flat_matches:
+            self._index_result(result)
+        if store is None:
+            store = MatchStore()
+            store.extend(self.flat_matches)
+        self.store = store
+        if len(store):
+            self.latest_result = from_epoch(int((store.start_time + store.duration).max()))
+        else:
+            self.latest_result = None
+        self.aggregates = MatchAggregates.from_store(store)
+        self.version += 1
+        self.averages.clear()
+        self.reports.clear()
+
+    def matches_for(self, player: str) -> List[Result]:
+        player_id = self.registry.lookup(player)
+        if player_id is None:
+            return []
+        return self.player_matches.get(player_id, [])
+
+    def player_totals(self, player: str) -> Tuple[int, int]:
+        filtered = self.matches_for(player)
+        return (sum(m.duration for m in filtered),
+                sum(m.game_count for m in filtered))
+
     def print_matches(self, data: str = 'all') -> None:
         if data in ('all', 'matches'):
             for matchup_lists in self.matches.values():
                 for match in matchup_lists:
                     print(match)
         if data in ('all', 'pending'):
-            for players, time in self.pending_matches.items():
-                print(players, time)
+            for pair, time in self.pending_matches.items():
+                print(self.registry.pair_names(pair), time)
 
-    def export_matches(self, filename='matches.csv') -> None:
-        with open(filename, 'w', encoding='utf-8') as file:
-            for matchup_lists in self.matches.values():
-                for match in matchup_lists:
-                    file.write(str(match) + '\n')
+    @perf.timed('database.export_matches')
+    def export_matches(self, filename: str = 'matches.csv',
+            selection: Optional[ExportFilter] = None,
+            incremental: bool = False) -> int:
+        return export_csv(self.store, filename, selection, incremental)
 
-    def save(self, data: str = 'all') -> None:
-        if data in ('all', 'pending'):
-            with open('pending_matches.pickle', 'wb') as file:
-                pickle.dump(self.pending_matches, file)
-        if data in ('all', 'matches'):
-            with open('matches.pickle', 'wb') as file:
-                pickle.dump(self.matches, file)
-            with open('flat_matches.pickle', 'wb') as file:
-                pickle.dump(self.flat_matches, file)
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
 
-    def load(self, data: str = 'all') -> None:
-        if data in ('all', 'pending'):
-            with open('pending_matches.pickle', 'rb') as file:
-                self.pending_matches = pickle.load(file)
-        if data in ('all', 'matches'):
-            if os.path.isfile('flat_matches.pickle'):
-                with open('flat_matches.pickle', 'rb') as file:
-                    self.flat_matches = pickle.load(file)
-            with open('matches.pickle', 'rb') as file:
-                self.matches = pickle.load(file)
+    def _log(self, record: Record) -> None:
+        if self.journaling and not self._replaying:
+            self.journal.append(record)
+
+    def _maybe_compact(self) -> None:
+        # only called between mutations, so the snapshot is consistent
+        if not self._replaying and self.journal.records >= COMPACT_EVERY:
+            self.save()
+
+    def _replay_journal(self) -> None:
+        self._replaying = True
+        try:
+            self.journal.records = 0
+            for record in self.journal.replay():
+                if record['op'] == 'match':
+                    self.add_match(tuple(record['players']), # type: ignore
+                            datetime.datetime.fromisoformat(record['start']))
+                elif record['op'] == 'result':
+                    self.add_results(tuple(record['players']), # type: ignore
+                            datetime.datetime.fromisoformat(record['end']),
+                            record['games'], record['division'])
+                elif record['op'] == 'checkpoint':
+                    self.checkpoint(record['channel'], record['message'])
+                elif record['op'] == 'alias':
+                    self.add_alias(record['alias'], record['name'])
+        finally:
+            self._replaying = False
+
+    def close(self) -> None:
+        self.journal.close()
+
+    @perf.timed('database.save')
+    def save(self) -> None:
+        """Compact the journal into a snapshot of the whole database."""
+        write_snapshot(self.store, self._path(RESULTS_FILE))
+        snapshot = {
+            'pending_matches': {self.registry.pair_names(pair): pending
+                for pair, pending in self.pending_matches.items()},
+            'pending_expiry': [(deadline, start, self.registry.pair_names(pair))
+                for deadline, start, pair in self._pending_expiry],
+            'checkpoints': self.checkpoints,
+            'aliases': self.registry.aliases,
+        }
+        temp_path = self._path(SNAPSHOT_FILE + '.tmp')
+        with open(temp_path, 'wb') as file:
+            pickle.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._path(SNAPSHOT_FILE))
+        # the rename has to be on disk before the journal is emptied
+        _fsync_directory(self.directory)
+        self.journal.truncate()
+
+    @perf.timed('database.load')
+    def load(self) -> None:
+        """Load the latest snapshot and replay the journal written since.
+
+        Falls back to the pickle files written by older versions of the bot
+        if there is no snapshot yet. Pending matches and results are always
+        loaded together, since journaled results need their pending match."""
+        if os.path.isfile(self._path(SNAPSHOT_FILE)):
+            with open(self._path(SNAPSHOT_FILE), 'rb') as file:
+                snapshot = pickle.load(file)
+            for alias, name in snapshot.get('aliases', {}).items():
+                self.registry.add_alias(alias, name)
+            self.checkpoints = snapshot.get('checkpoints', {})
+            store = None
+            if 'flat_matches' in snapshot:
+                self.flat_matches = snapshot['flat_matches']
+            else:
+                # copy out of the memory map so the file can be replaced
+                store = read_snapshot(self._path(RESULTS_FILE)).copy()
+                self.flat_matches = store.results()
+                if any(self.registry.canonical(player) != player for player in store.players):
+                    # saved before an alias merged some of its players
+                    store = None
+            self._set_matches()
+            self._rebuild_index(store)
+            self._set_pending(snapshot['pending_matches'])
+            # keep the deadlines as they were, so replaying the journal
+            # expires exactly what the running bot did
+            self._pending_expiry = [(deadline, start, self.registry.pair(players))
+                for deadline, start, players in snapshot['pending_expiry']]
+            heapq.heapify(self._pending_expiry)
+        elif os.path.isfile(self._path('matches.pickle')):
+            self._load_pickles()
+        else:
+            # nothing saved yet, only the journal
+            self.wipe()
+        self._replay_journal()
+
+    def _load_pickles(self) -> None:
+        with open(self._path('pending_matches.pickle'), 'rb') as file:
+            self._set_pending(pickle.load(file))
+        if os.path.isfile(self._path('flat_matches.pickle')):
+            with open(self._path('flat_matches.pickle'), 'rb') as file:
+                self.flat_matches = pickle.load(file)
+        else:
+            with open(self._path('matches.pickle'), 'rb') as file:
+                self.flat_matches = sum(pickle.load(file).values(), [])
+        self._set_matches()
+        self._rebuild_index()
+        # after the matches, deadlines depend on the latest result
+        self._rebuild_pending()
+
+    def _set_pending(self, pending_matches: Dict[Players, List[datetime.datetime]]) -> None:
+        # saved by name, as ids are only meaningful within one process
+        self.pending_matches = {}
+        for players, pending in pending_matches.items():
+            self.pending_matches.setdefault(self.registry.pair(players), []).extend(pending)
+        for pending in self.pending_matches.values():
+            pending.sort()
+
+    def _set_matches(self) -> None:
+        self.matches = {}
+        for result in self.flat_matches:
+            self.matches.setdefault(result.player_ids, []).append(result)
 
     def wipe(self, data: str = 'all') -> None:
         if data in ('all', 'pending'):
             self.pending_matches = {}
+            self._pending_expiry = []
         if data in ('all', 'matches'):
             self.matches = {}
+            self.match_times = {}
+            self.flat_matches = []
+            self.player_matches = {}
+            self.latest_result = None
+            self.store.clear()
+            self.aggregates = MatchAggregates()
+            self.version += 1
+            self.averages.clear()
+            self.reports.clear()
+            self.checkpoints = {}
+
+def open_database(backend: str = 'memory', directory: str = '.') -> ShardedDatabase:
+    """A database sharded per guild, with shards of the given backend."""
+    if backend == 'sqlite':
+        # pylint: disable=import-outside-toplevel,cyclic-import
+        from sqlite_database import SqliteDatabase
+        return ShardedDatabase(
+                lambda shard: SqliteDatabase(os.path.join(shard, 'matches.sqlite')),
+                directory)
+    return ShardedDatabase(Database, directory)
 
-database = Database()
+database = open_database(os.environ.get('DATABASE_BACKEND', 'memory'))
@@ -1,11 +1,15 @@
 #!env/bin/python3
 # pragma pylint: disable=missing-docstring
-from typing import Dict, List
+from typing import Dict, List, Optional
+import asyncio
 import datetime
+import os
 
 import discord  # type: ignore
 
 import discord_commands as commands
+from ingestion import IngestionQueue
+import perf
 
 from seat_typing import SeatException, SeatChannel, DiscordUser
 
@@ -21,6 +25,9 @@ class DiscordBot(discord.Client):  # type: ignore
         self.command_list: List[commands.CommandType] = []
         self.command_dict: Dict[str, List[commands.CommandType]] = {}
 
+        self.ingestion = IngestionQueue()
+        self._perf_dump: Optional[asyncio.Task] = None
+
         self._initialize_commands()
 
     def _initialize_commands(self) -> None:
@@ -31,10 +38,17 @@ class DiscordBot(discord.Client):  # type: ignore
             commands.Source(),
 
             commands.PlayerStats(),
+            commands.Summary(),
+            commands.Chart(),
             commands.PrintMatches(),
             commands.Pickle(),
 
             commands.Update(self),
+            commands.Archive(self),
+            commands.IngestStatus(self.ingestion),
+            commands.Alias(),
+            commands.Perf(),
+            commands.Profile(),
             commands.Shutdown(self),
         ]
 
@@ -47,11 +61,16 @@ class DiscordBot(discord.Client):  # type: ignore
 
     async def on_ready(self) -> None:
         print(f'Logged in as {self.user} at {datetime.datetime.now()}')
+        self.ingestion.start()
+        dump_interval = float(os.environ.get('PERF_DUMP_INTERVAL', 0))
+        if dump_interval and self._perf_dump is None:
+            self._perf_dump = asyncio.create_task(perf.dump_periodically(dump_interval))
         # for guild in self.guilds:
         #     for channel in guild.channels:
         #         if channel.name == 'testing':
         #             await channel.send('Seat Exchange Bot v0.1')
 
+    @perf.timed('on_message')
     async def on_message(self, message: discord.message) -> None:
         """
         If message from:
@@ -80,11 +99,8 @@ class DiscordBot(discord.Client):  # type: ignore
             return
 
         if isinstance(message.channel, discord.channel.TextChannel):
-            if message.channel.name == 'matches':
-                commands.parse_matches_message(message)
-                return
-            if message.channel.name == 'results':
-                commands.parse_results_message(message)
+            if message.channel.name in ('matches', 'results'):
+                await self.ingestion.put(message)
                 return
 
         if not message.channel.type == discord.ChannelType.private:
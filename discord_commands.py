@@ -2,9 +2,12 @@
 """
 from __future__ import annotations
 
+import io
 import itertools
+import os
 import datetime
-#import asyncio
+import asyncio
+import heapq
 from enum import Enum, auto
 import typing
 from typing import Optional, List, Any, Sequence
@@ -12,12 +15,23 @@ from dataclasses import dataclass
 
 import discord  # type: ignore
 
+import archive
+import charts
+import export
 import seat_strings
 import seat_typing
 import game_statistics
+import workers
+import perf
+import profiler
+from cache import LRUCache
 from seat_typing import GameState
 from database import database
 
+if typing.TYPE_CHECKING:
+    # pylint: disable=cyclic-import
+    from ingestion import IngestionQueue
+
 #if typing.TYPE_CHECKING:
 #    # pylint: disable=cyclic-import
 #    import discord_game
@@ -29,6 +43,14 @@ from database import database
 OPTIONAL_STR = "Brackets around an argument means that it's optional."
 REVEAL_TIME = 5
 
+BACKFILL_CONCURRENCY = 4
+BACKFILL_WINDOW = datetime.timedelta(days=1)
+CHECKPOINT_EVERY = 200
+
+# channels !update has read up to the present in this process, so a live
+# message there has nothing unparsed before it and can move the checkpoint
+synced_channels: typing.Set[int] = set()
+
 
 class CommandException(seat_typing.SeatException):
     def __init__(self, command: typing.Union[CommandType, CommandMessage],
@@ -79,6 +101,7 @@ class CommandMessage:
 
         self.author: seat_typing.DiscordUser = author
         self.channel = channel
+        self.guild_id = guild_id(message)
         self.command: str = message.content.split(' ')[0][1:]
         self.args: List[Any] = message.content.split(' ')[1:]
 
@@ -230,7 +253,13 @@ class CommandType():
 
         self._validate_channel(command.channel)
 
-        await self._do_execute(command)
+        profiled = profiler.session
+        try:
+            with perf.timed(f'command.{self.command_name}'):
+                await self._do_execute(command)
+        finally:
+            if profiled is not None:
+                await profiler.command_finished(profiled)
         return
 
 
@@ -355,11 +384,99 @@ class PlayerStats(CommandType):
 
     async def _do_execute(self, command: CommandMessage) -> None:
         player: str = command.convert_arguments(self.args)[0]
+        shard = database.shard(command.guild_id)
+        # the workers don't know the aliases
+        player = shard.registry.canonical(player)
 
-        await command.channel.send(
-                game_statistics.player_stats(player,
-                    database.flat_matches))
+        try:
+            report = await workers.player_report(shard, player)
+        except asyncio.TimeoutError as error:
+            raise CommandException(self, f'Timed out computing stats for {player}.') from error
+        except Exception as error: #pylint: disable=broad-except
+            raise CommandException(self,
+                    f'Failed computing stats for {player}: {error}') from error
+        await command.channel.send(report)
 
+class Summary(CommandType):
+    def __init__(self) -> None:
+        help_text = 'Prints statistics across all recorded matches.'
+        requirements = Requirements(private_only=True)
+        super().__init__('summary', 'stats',
+                         help_text=help_text,
+                         requirements=requirements,
+                         tag=CommandTag.INFO)
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        await command.channel.send(game_statistics.summary(database.shard(command.guild_id)))
+
+def _database_time(time: datetime.datetime) -> datetime.datetime:
+    # discord gives aware datetimes, the database keeps naive UTC like the
+    # results saved by older versions of discord.py
+    if time.tzinfo is None:
+        return time
+    return time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+class Chart(CommandType):
+    def __init__(self) -> None:
+        help_text = ('DMs a chart: `correlation` of match length against the players\' '
+                'averages, `player name` for their average game length over time, or '
+                '`divisions` for the spread of game length in each division, optionally '
+                'only those containing e.g. `tier`.')
+        requirements = Requirements(private_only=True)
+        args = (ArgType(str, name='correlation|player|divisions'),
+                ArgType(str, name='player|tier', optional=True, defaultvalue='',
+                    multi_word=True),
+                )
+        super().__init__('chart', 'plot',
+                         help_text=help_text,
+                         requirements=requirements,
+                         args=args,
+                         tag=CommandTag.INFO)
+        # (kind, argument, guild, shard version) -> png, so a chart is only
+        # rendered again once new results have come in
+        self.cache: LRUCache[typing.Tuple[str, str, Optional[int], int], bytes] = LRUCache(
+                maxsize=32)
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        kind: str
+        argument: str
+        kind, argument = command.convert_arguments(self.args)
+        kind = kind.lower()
+        if kind not in charts.CHARTS:
+            raise CommandException(self, f'unknown chart: {kind}')
+        shard = database.shard(command.guild_id)
+        if kind == 'player':
+            if not argument:
+                raise CommandException(self, 'which player?')
+            # the workers don't know the aliases
+            argument = shard.registry.canonical(argument)
+        elif kind == 'correlation':
+            argument = ''
+
+        key = (kind, argument, command.guild_id, shard.version)
+        png = self.cache.get(key)
+        if png is None:
+            try:
+                png = await workers.stats_pool.run(shard, workers.chart_job, kind, argument)
+            except asyncio.TimeoutError as error:
+                raise CommandException(self, f'Timed out drawing the {kind} chart.') from error
+            except ValueError as error:
+                raise CommandException(self, str(error)) from error
+            except Exception as error: #pylint: disable=broad-except
+                raise CommandException(self,
+                        f'Failed drawing the {kind} chart: {error}') from error
+            self.cache.put(key, png)
+        await command.author.send(file=discord.File(io.BytesIO(png), filename=f'{kind}.png'))
+
+def guild_id(message: discord.message) -> typing.Optional[int]:
+    """Which shard of the database a message belongs to. A DM belongs to
+    the guild its author shares with the bot, if there's only one."""
+    if message.guild is not None:
+        return message.guild.id
+    guilds = getattr(message.author, 'mutual_guilds', [])
+    return guilds[0].id if len(guilds) == 1 else None
+
+@perf.timed('parse.matches')
 def parse_matches_message(message: discord.message, verbose: bool = False) -> int:
     if verbose:
         print(f'parsing matches message: {message.id}')
@@ -373,6 +490,7 @@ def parse_matches_message(message: discord.message, verbose: bool = False) -> in
             print('wrong title')
         return 0
 
+    shard = database.shard(guild_id(message))
     added = 0
     for field in embed.fields:
         if 'League' not in field.name:
@@ -384,7 +502,7 @@ def parse_matches_message(message: discord.message, verbose: bool = False) -> in
                 print('not a league game')
             continue
 
-        timestamp = message.created_at + datetime.timedelta(minutes=1)
+        timestamp = _database_time(message.created_at) + datetime.timedelta(minutes=1)
 
         try:
             players = tuple(field.name.split(':')[1].strip().split(' vs. '))
@@ -393,10 +511,11 @@ def parse_matches_message(message: discord.message, verbose: bool = False) -> in
             print(f'Failed to parse {field.name}')
             continue
 
-        if database.add_match(players, timestamp, verbose):
+        if shard.add_match(players, timestamp, verbose):
             added += 1
     return added
 
+@perf.timed('parse.results')
 def parse_results_message(message: discord.message, verbose: bool = False) -> bool:
     if verbose:
         print(f'parsing results message: {message.id}')
@@ -407,7 +526,7 @@ def parse_results_message(message: discord.message, verbose: bool = False) -> bo
         return False
     embed = message.embeds[0]
     division = embed.title.split(' ')[-1]
-    timestamp = message.created_at
+    timestamp = _database_time(message.created_at)
 
     try:
         ppb = embed.fields[0].name.split(' - ')
@@ -416,14 +535,80 @@ def parse_results_message(message: discord.message, verbose: bool = False) -> bo
         games = int(float(ppbs[0][-1]) + float(ppbs[1][0]))
         players = ' '.join(ppbs[0][:-1]), ' '.join(ppbs[1][1:])
 
-        return database.add_results(players, timestamp, games, division)
+        return database.shard(guild_id(message)).add_results(
+                players, timestamp, games, division)
     except ValueError:
         print(f'failed to parse {embed.fields[0].name}')
     return False
 
+def parse_live_message(message: discord.message) -> None:
+    if message.channel.name == 'matches':
+        parse_matches_message(message)
+    else:
+        parse_results_message(message)
+    if message.channel.id in synced_channels:
+        database.shard(guild_id(message)).checkpoint(message.channel.id, message.id)
+
+async def _fetch_window(channel: discord.TextChannel,
+        after: typing.Union[datetime.datetime, discord.Object],
+        before: datetime.datetime,
+        semaphore: asyncio.Semaphore) -> List[discord.Message]:
+    async with semaphore:
+        return [message async for message in channel.history(
+            after=after,
+            before=before,
+            limit=None,
+            oldest_first=True)]
+
+def _split_windows(after: datetime.datetime,
+        before: datetime.datetime,
+        window: datetime.timedelta
+        ) -> List[typing.Tuple[datetime.datetime, datetime.datetime]]:
+    windows = []
+    start = after
+    while start < before:
+        end = min(start + window, before)
+        windows.append((start, end))
+        # after and before are both exclusive, at millisecond resolution
+        start = end - datetime.timedelta(milliseconds=1) if end < before else end
+    return windows
+
+async def fetch_history(channels: Sequence[discord.TextChannel], #pylint: disable=too-many-arguments
+        after: datetime.datetime,
+        before: datetime.datetime,
+        concurrency: int = BACKFILL_CONCURRENCY,
+        window: datetime.timedelta = BACKFILL_WINDOW,
+        checkpoints: Optional[typing.Dict[int, int]] = None,
+        ) -> typing.Iterator[discord.Message]:
+    """Fetch the history of all channels between after and before, split into
+    windows that are requested concurrently, and merge it in time order.
+
+    Channels with an entry in checkpoints are instead read from just after
+    that message id."""
+    semaphore = asyncio.Semaphore(concurrency)
+    requests = []
+    for channel in channels:
+        start = after
+        first_after: typing.Union[datetime.datetime, discord.Object] = after
+        if checkpoints and channel.id in checkpoints:
+            first_after = discord.Object(id=checkpoints[channel.id])
+            start = discord.utils.snowflake_time(checkpoints[channel.id])
+
+        for window_after, window_before in _split_windows(start, before, window):
+            requests.append(_fetch_window(channel,
+                first_after if window_after == start else window_after,
+                window_before, semaphore))
+
+    chunks = await asyncio.gather(*requests)
+
+    return heapq.merge(*chunks, key=lambda message: message.created_at)
+
 class Update(CommandType):
-    def __init__(self, client: discord.Client):
-        help_text = ('Goes through the specified date range and adds all matches to the database.')
+    def __init__(self, client: discord.Client,
+            concurrency: int = BACKFILL_CONCURRENCY):
+        help_text = ('Goes through the specified date range and adds all matches to the database.\n'
+                'Without a range it continues from the last message parsed in each '
+                'channel, or reads the last day for channels it has not seen.')
         requirements = Requirements(admin_only=True)
         args = (ArgType(int, optional=True, name='after'),
                 ArgType(int, optional=True, name='before'),
@@ -436,6 +621,8 @@ class Update(CommandType):
                          help_text=help_text,
                          tag=CommandTag.ADMIN)
         self.client = client
+        self.concurrency = concurrency
+        self._refresh: Optional[asyncio.Task] = None
 
     async def _do_execute(self, command: CommandMessage) -> None:
         after_utc: Optional[int]
@@ -450,58 +637,285 @@ class Update(CommandType):
 
         verbose = verbosity == 'verbose'
 
+        # aware, to compare with the snowflake times of checkpoints
+        now = datetime.datetime.now(datetime.timezone.utc)
         if not after_utc:
-            after = datetime.datetime.now() - datetime.timedelta(days=1)
+            after = now - datetime.timedelta(days=1)
         else:
-            after = datetime.datetime.fromtimestamp(after_utc)
+            after = datetime.datetime.fromtimestamp(after_utc, datetime.timezone.utc)
         if not before_utc:
-            before = datetime.datetime.now()
+            before = now
         else:
-            before = datetime.datetime.fromtimestamp(before_utc)
+            before = datetime.datetime.fromtimestamp(before_utc, datetime.timezone.utc)
 
         matches_parsed, results_parsed = 0, 0
-
+        # every guild is a league of its own, with its own shard of the database
         for guild in self.client.guilds:
-            for channel in guild.channels:
-                if channel.name == 'matches':
-                    async for message in channel.history(
-                            after=after,
-                            before=before,
-                            limit=None):
-                        if parse_matches_message(message, verbose):
-                            matches_parsed += 1
-                if channel.name == 'results':
-                    async for message in channel.history(
-                            after=after,
-                            before=before,
-                            limit=None):
-                        if parse_results_message(message, verbose):
-                            results_parsed += 1
+            matches, results = await self._update_guild(guild, after, before,
+                    not after_utc, verbose)
+            matches_parsed += matches
+            results_parsed += results
+        if not after_utc and not before_utc:
+            synced_channels.update(channel.id
+                    for guild in self.client.guilds for channel in guild.channels
+                    if channel.name in ('matches', 'results'))
         await command.author.send(f'added {matches_parsed} matches and {results_parsed} results')
 
+        # recompute the !player reports the new results made stale in the background
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._refresh_reports())
+
+    async def _refresh_reports(self) -> None:
+        for guild in self.client.guilds:
+            await workers.refresh_reports(database.shard(guild.id))
+
+    async def _update_guild(self, #pylint: disable=too-many-arguments
+            guild: discord.Guild,
+            after: datetime.datetime,
+            before: datetime.datetime,
+            resume: bool,
+            verbose: bool) -> typing.Tuple[int, int]:
+        shard = database.shard(guild.id)
+        matches_parsed, results_parsed = 0, 0
+        checkpoints = shard.checkpoints if resume else None
+        latest: typing.Dict[int, int] = {}
+
+        channels = [channel for channel in guild.channels
+                if channel.name in ('matches', 'results')]
+
+        # results have to be parsed after the match they belong to, so both
+        # channels are read as one stream in time order
+        history = await fetch_history(channels, after, before, self.concurrency,
+                checkpoints=checkpoints)
+        for parsed, message in enumerate(history, start=1):
+            if message.channel.name == 'matches':
+                if parse_matches_message(message, verbose):
+                    matches_parsed += 1
+            elif parse_results_message(message, verbose):
+                results_parsed += 1
+
+            # everything before this message in the merged stream is parsed,
+            # so a crash resumes from the last checkpoint of every channel
+            latest[message.channel.id] = message.id
+            if parsed % CHECKPOINT_EVERY == 0:
+                for channel_id, message_id in latest.items():
+                    shard.checkpoint(channel_id, message_id)
+
+        for channel_id, message_id in latest.items():
+            shard.checkpoint(channel_id, message_id)
+        return matches_parsed, results_parsed
+
+
+class Archive(CommandType):
+    def __init__(self, client: discord.Client):
+        help_text = ('Appends all #matches and #results messages in the specified date '
+                'range to archive.jsonl, for rebuilding the database offline with replay.py.')
+        requirements = Requirements(admin_only=True)
+        args = (ArgType(int, name='after'),
+                ArgType(int, optional=True, name='before'),
+                )
+        super().__init__('archive',
+                         args=args,
+                         requirements=requirements,
+                         help_text=help_text,
+                         tag=CommandTag.ADMIN)
+        self.client = client
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        after_utc: int
+        before_utc: Optional[int]
+        after_utc, before_utc = command.convert_arguments(self.args)
+
+        after = datetime.datetime.fromtimestamp(after_utc)
+        if not before_utc:
+            before = datetime.datetime.now()
+        else:
+            before = datetime.datetime.fromtimestamp(before_utc)
+
+        channels = [channel
+                for guild in self.client.guilds
+                for channel in guild.channels
+                if channel.name in ('matches', 'results')]
+        written = archive.write_archive('archive.jsonl',
+                await fetch_history(channels, after, before))
+        await command.author.send(f'archived {written} messages')
+
+
+class Alias(CommandType):
+    def __init__(self) -> None:
+        help_text = ('Makes `alias` another name of `player` in this server\'s league, '
+                'e.g. after they renamed their account, so their matches under both names '
+                'are counted together. '
+                'Matches already played as `alias` are moved to `player`.')
+        requirements = Requirements(admin_only=True)
+        args = (ArgType(str, name='alias'),
+                ArgType(str, name='player', multi_word=True))
+        super().__init__('alias',
+                         args=args,
+                         requirements=requirements,
+                         help_text=help_text,
+                         tag=CommandTag.ADMIN)
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        alias: str
+        player: str
+        alias, player = command.convert_arguments(self.args)
+        # aliases only apply to the league of the guild they're added in
+        shard = database.shard(command.guild_id)
+        try:
+            shard.add_alias(alias, player)
+        except ValueError as exception:
+            raise CommandException(self, str(exception)) from exception
+        await command.author.send(
+                f'{alias} is now an alias of {shard.registry.canonical(player)}')
+
+
+class Perf(CommandType):
+    def __init__(self) -> None:
+        help_text = ('DMs call counts and p50/p95/p99 latencies of the timed parts of the bot, '
+                'optionally only those whose name starts with a prefix, e.g. `command`. '
+                '`!perf reset` clears them.')
+        requirements = Requirements(admin_only=True)
+        args = (ArgType(str, optional=True, name='prefix'),)
+        super().__init__('perf',
+                         args=args,
+                         requirements=requirements,
+                         help_text=help_text,
+                         tag=CommandTag.ADMIN)
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        prefix: Optional[str] = command.convert_arguments(self.args)[0]
+        if prefix == 'reset':
+            perf.reset()
+            await command.author.send('reset timings')
+            return
+        await command.author.send(perf.report(prefix))
+
+
+class Profile(CommandType):
+    def __init__(self) -> None:
+        help_text = ('Profiles the bot with cProfile for the next `amount` commands, '
+                'or `amount` seconds, then saves the stats to disk and DMs the top '
+                'functions by cumulative time. `!profile stop` ends it early.')
+        requirements = Requirements(admin_only=True)
+        args = (ArgType(str, name='amount'),
+                ArgType(str, optional=True, name='commands|seconds',
+                        defaultvalue='commands'))
+        super().__init__('profile',
+                         args=args,
+                         requirements=requirements,
+                         help_text=help_text,
+                         tag=CommandTag.ADMIN)
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        amount: str
+        unit: str
+        amount, unit = command.convert_arguments(self.args)
+        if amount == 'stop':
+            if await profiler.stop() is None:
+                await command.author.send('not profiling')
+            return
+
+        try:
+            count = float(amount)
+        except ValueError as exception:
+            raise CommandException(self, f'invalid amount: {amount}') from exception
+        if count <= 0:
+            raise CommandException(self, f'invalid amount: {amount}')
+        if unit == 'commands':
+            session = profiler.ProfileSession(command.author, commands=int(count))
+        elif unit == 'seconds':
+            session = profiler.ProfileSession(command.author, seconds=count)
+        else:
+            raise CommandException(self, f'invalid unit: {unit}')
+
+        try:
+            profiler.start(session)
+        except ValueError as exception:
+            raise CommandException(self, f'could not start profiling: {exception}') from exception
+        await command.author.send(f'profiling {session.describe()}')
+
+
+class IngestStatus(CommandType):
+    def __init__(self, ingestion: IngestionQueue):
+        help_text = 'Prints the depth and lag of the #matches/#results ingestion queue.'
+        requirements = Requirements(admin_only=True)
+        super().__init__('queue', 'ingest',
+                         requirements=requirements,
+                         help_text=help_text,
+                         tag=CommandTag.ADMIN)
+        self.ingestion = ingestion
+
+    async def _do_execute(self, command: CommandMessage) -> None:
+        await command.author.send(self.ingestion.status())
+
 
 class PrintMatches(CommandType):
     def __init__(self):
+        help_text = ('Prints the matches of this server\'s league to the terminal, or with '
+                '`file` exports them to matches.csv. An export can be filtered with `after=YYYY-MM-DD`, '
+                '`before=YYYY-MM-DD`, `division=...` and `player=...`, and `new` only '
+                'appends the matches added since the previous export.')
         requirements = Requirements(admin_only=True)
         args = (ArgType(str, optional=True, name='target', defaultvalue='tty'),
-                ArgType(str, name='data', optional=True, defaultvalue='all'),
+                ArgType(str, name='data', optional=True, defaultvalue='all',
+                    multi_word=True),
                 )
         super().__init__('printmatches', 'print',
                          requirements=requirements,
                          args=args,
+                         help_text=help_text,
                          tag=CommandTag.ADMIN)
 
+    def _parse_export(self, data: str) -> typing.Tuple[export.ExportFilter, bool]:
+        selection = export.ExportFilter()
+        incremental = False
+        for option in data.split():
+            key, _, value = option.partition('=')
+            try:
+                if option in ('all', 'matches'):
+                    pass
+                elif option == 'new':
+                    incremental = True
+                elif key in ('after', 'before'):
+                    setattr(selection, key, datetime.datetime.fromisoformat(value))
+                elif key == 'division' and value:
+                    selection.division = value
+                elif key == 'player' and value:
+                    selection.player = value
+                else:
+                    raise ValueError(option)
+            except ValueError as exception:
+                raise CommandException(self, f'invalid export option: {option}') from exception
+        return selection, incremental
+
     async def _do_execute(self, command: CommandMessage) -> None:
         target : str
         data : str
         target, data = command.convert_arguments(self.args)
 
+        # only the league of the guild the command is sent in
+        shard = database.shard(command.guild_id)
         if target == 'tty':
-            database.print_matches(data)
+            shard.print_matches(data)
             await command.author.send('printed to tty')
         elif target == 'file':
-            database.export_matches()
-            await command.author.send('printed to file')
+            selection, incremental = self._parse_export(data)
+            if selection.player is not None:
+                # the workers don't know the aliases
+                selection.player = shard.registry.canonical(selection.player)
+            # to the matches.csv in the shard's directory, formatting a long
+            # history takes a while so it's done in the stats pool
+            filename = os.path.join(database.shard_directory(command.guild_id), 'matches.csv')
+            try:
+                rows = await workers.stats_pool.run(shard, workers.export_job,
+                        filename, selection, incremental,
+                        timeout=workers.EXPORT_TIMEOUT)
+            except asyncio.TimeoutError as error:
+                raise CommandException(self, 'Timed out exporting matches.') from error
+            except Exception as error: #pylint: disable=broad-except
+                raise CommandException(self, f'Failed exporting matches: {error}') from error
+            await command.author.send(f'printed {rows} matches to file')
         else:
             await command.author.send(f'invalid printing target: {target}')
 
@@ -524,12 +938,17 @@ class Pickle(CommandType):
         action, data = command.convert_arguments(
             self.args)
 
+        # the snapshot and journal always hold everything, only wipe can
+        # be limited to part of the data. load and save only touch the
+        # shards in use, wipe only the one of the guild the command is sent in.
         if action == 'load':
-            database.load(data)
+            database.load()
+            data = 'all'
         elif action == 'save':
-            database.save(data)
+            database.save()
+            data = 'all'
         elif action == 'wipe':
-            database.wipe(data)
+            database.shard(command.guild_id).wipe(data)
         else:
             await command.author.send(f'invalid action: {action}')
             return
@@ -551,4 +970,5 @@ class Shutdown(CommandType):
 
     async def _do_execute(self, command: CommandMessage) -> None:
         await command.channel.wait_send('Shutting down.')
+        database.close()
         await self.client.close()
@@ -0,0 +1,99 @@
+"""Streaming csv export of the results in a MatchStore.
+
+Rows are formatted a chunk at a time from the store's columns and written
+with the csv module, in the order the results were added. How many rows
+the store had at the last export is remembered in a small file next to the
+csv, so an incremental export only appends the rows added since.
+"""
+import csv
+import datetime
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy #type: ignore
+
+from match_store import MatchStore
+from seat_typing import to_epoch
+from player_registry import normalize
+
+CHUNK_SIZE = 10000
+BUFFER_SIZE = 1 << 20
+
+
+@dataclass
+class ExportFilter:
+    after: Optional[datetime.datetime] = None
+    before: Optional[datetime.datetime] = None
+    division: Optional[str] = None
+    player: Optional[str] = None
+
+    def rows(self, store: MatchStore, start: int = 0) -> numpy.ndarray:
+        """Indices of the rows from start on that pass the filter."""
+        selected = numpy.ones(len(store) - start, dtype=bool)
+        if self.after is not None:
+            selected &= store.start_time[start:] >= to_epoch(self.after)
+        if self.before is not None:
+            selected &= store.start_time[start:] < to_epoch(self.before)
+        if self.division is not None:
+            division_id = store.division_ids.get(self.division, -1)
+            selected &= store.division[start:] == division_id
+        if self.player is not None:
+            # the store doesn't know the aliases, the player is the name it's stored under
+            player_id = store.player_ids.get(normalize(self.player), -1)
+            selected &= ((store.player_a[start:] == player_id)
+                    | (store.player_b[start:] == player_id))
+        return numpy.flatnonzero(selected) + start
+
+
+def _position_file(filename: str) -> str:
+    return filename + '.position'
+
+def _read_position(filename: str) -> int:
+    try:
+        with open(_position_file(filename), encoding='utf-8') as file:
+            return int(json.load(file)['rows'])
+    except (OSError, ValueError, KeyError):
+        return 0
+
+def _write_position(filename: str, rows: int) -> None:
+    with open(_position_file(filename), 'w', encoding='utf-8') as file:
+        json.dump({'rows': rows}, file)
+
+def export_csv(store: MatchStore, #pylint: disable=too-many-locals
+        filename: str = 'matches.csv',
+        selection: Optional[ExportFilter] = None,
+        incremental: bool = False,
+        chunk_size: int = CHUNK_SIZE) -> int:
+    """Write player, player, start, duration, games, division rows to
+    filename. Returns the number of rows written.
+
+    If incremental, rows already exported to filename by an earlier export
+    are skipped and the new ones appended. If the store has shrunk since,
+    e.g. after a wipe, everything is exported again."""
+    start = _read_position(filename) if incremental else 0
+    if start > len(store) or not os.path.exists(filename):
+        start = 0
+    end = len(store)
+    rows = (selection or ExportFilter()).rows(store, start)
+    players = numpy.array(store.players, dtype=object)
+    divisions = numpy.array(store.divisions, dtype=object)
+
+    mode = 'a' if start else 'w'
+    with open(filename, mode, newline='', encoding='utf-8', buffering=BUFFER_SIZE) as file:
+        writer = csv.writer(file, lineterminator='\n')
+        for offset in range(0, len(rows), chunk_size):
+            chunk = rows[offset:offset+chunk_size]
+            start_times = (store.start_time[chunk].astype('datetime64[s]')
+                    .astype('datetime64[m]').astype(str))
+            writer.writerows(zip(
+                    players[store.player_a[chunk]],
+                    players[store.player_b[chunk]],
+                    start_times,
+                    store.duration[chunk].tolist(),
+                    store.game_count[chunk].tolist(),
+                    divisions[store.division[chunk]]))
+
+    _write_position(filename, end)
+    return len(rows)
@@ -1,15 +1,20 @@
 #!env/bin/python3
+import os
 import pickle
-import statistics
+import sys
 #import pprint
-from typing import List,Dict
+from typing import Any, List, Dict, Optional, Set, Tuple
+from dataclasses import dataclass
 
 import numpy #type: ignore
-from matplotlib import pyplot
 
 from seat_typing import Result, Players
+from player_registry import names
+from database import Database, open_database
+from binary_snapshot import SnapshotDatabase
+from weighted_stats import WeightedStats
+import perf
 
-CACHED_AVERAGES = {}
 def load_data(filename: str) -> Dict[Players, List[Result]]:
     with open(filename, 'rb') as file:
         return pickle.load(file) #type: ignore
@@ -17,6 +22,15 @@ def load_data(filename: str) -> Dict[Players, List[Result]]:
 def load_matches() -> List[Result]:
     return sum(load_data('matches.pickle').values(), [])
 
+def load_database(snapshot: Optional[str] = None) -> Database:
+    """Load the saved database of every guild like the bot does, or only a
+    binary results snapshot if given a path to one."""
+    if snapshot is not None:
+        return SnapshotDatabase(snapshot) # type: ignore
+    database = open_database(os.environ.get('DATABASE_BACKEND', 'memory'))
+    database.load()
+    return database # type: ignore
+
 def format_duration(duration: float, decimal_seconds: bool = False) -> str:
     hours = int(duration // 3600)
     minutes = int((duration % 3600 ) // 60)
@@ -38,172 +52,227 @@ def format_basic_stats(source: str, time: int, games: int) -> str:
     return f'{source}: {format_duration(time/games)} across {games} games'
 
 
-def average(player: str, matches: List[Result]) -> float:
-    if player in CACHED_AVERAGES:
-        return CACHED_AVERAGES[player]
+def _opponent(player_id: Optional[int], match: Result) -> str:
+    first, second = match.player_ids
+    return names.name(second if first == player_id else first)
 
-    filtered = tuple(filter(lambda x: x.contains(player), matches))
-    time = sum((m.duration for m in filtered))
-    games = sum((m.game_count for m in filtered))
+def average(player: str, database: Database) -> float:
+    # a new result changes the version, so stale averages are never found
+    key = (database.registry.canonical(player), database.version)
+    cached = database.averages.get(key)
+    if cached is not None:
+        return cached
+
+    time, games = database.player_totals(player)
     if games == 0:
         print(f'no games found for {player}')
     avg = time/games
-    CACHED_AVERAGES[player] = avg
+    database.averages.put(key, avg)
     return avg
 
-def adaptability(player: str, matches: List[Result]) -> float:
-    def opponent(players: Players) -> str:
-        if player.lower() == players[0].lower():
-            return players[1]
-        return players[0]
-
-    filtered = filter(lambda x: x.contains(player), matches)
-
+def adaptability(player: str, database: Database) -> float:
     duration_diff = []
     avg_diff = []
-    avg = average(player, matches)
+    avg = average(player, database)
 
-    for match in filtered:
+    matches = database.matches_for(player)
+    # a SnapshotDatabase only registers the players of the matches it returns
+    player_id = database.registry.lookup(player)
+    for match in matches:
         duration_diff.append(match.duration / match.game_count / avg)
-        oppo = opponent(match.players)
-        avg_diff.append(average(oppo, matches) / avg)
+        oppo = _opponent(player_id, match)
+        avg_diff.append(average(oppo, database) / avg)
 
     #print(','.join(map(str, map(round, duration_diff))))
     #print(','.join(map(str, map(round, avg_diff))))
 
     return numpy.polyfit(duration_diff, avg_diff, 1)[0] # type: ignore
 
-def player_stats(player: str, matches: List[Result]) -> str: #pylint: disable=too-many-locals
-    def opponent(players: Players) -> str:
-        if player.lower() == players[0].lower():
-            return players[1]
-        return players[0]
-
-
-    filtered = sorted(filter(lambda x: x.contains(player), matches), key=lambda x:x.start_time)
+@perf.timed('statistics.player_stats')
+def player_stats(player: str, database: Database) -> str: #pylint: disable=too-many-locals
+    filtered = sorted(database.matches_for(player), key=lambda x:x.start_epoch)
+    player_id = database.registry.lookup(player)
 
     time = sum((m.duration for m in filtered))
     games = sum((m.game_count for m in filtered))
     averages = tuple(m.duration / m.game_count for m in filtered)
 
-    res = f'Stats for {player}\n'
-    res += 'WARNING: Noisy, incomplete and likely even incorrect data!\n'
-
-    opponents = []
-    res += 'Average game times\n'
+    lines = [f'Stats for {player}',
+            'WARNING: Noisy, incomplete and likely even incorrect data!',
+            'Average game times']
     for match in filtered:
-        oppo = opponent(match.players)
-        opponents.append(oppo)
-        res += (f'\t{format_duration(match.duration/match.game_count):6} '
-                f'in {match.game_count} vs {oppo}\n')
-
-    res += format_basic_stats('Total', time, games) + '\n'
+        lines.append(f'\t{format_duration(match.duration/match.game_count):6} '
+                f'in {match.game_count} vs {_opponent(player_id, match)}')
 
-    weighted_matches: List[float] = sum(
-            ([m.duration/m.game_count]*m.game_count for m in filtered), [])
-    res += f'stdev: {statistics.stdev(weighted_matches)/60:.2}m\n'
+    lines.append(format_basic_stats('Total', time, games))
+    lines.append(f'stdev: {player_stdev(player, database)/60:.2}m')
 
     trend : float= numpy.polyfit(range(len(filtered)), averages, 1)[0] # type: ignore
-    res += f'Trend: {trend:.2f}s\n'
+    lines.append(f'Trend: {trend:.2f}s')
 
     # Adaptability
 
-    res += f'Adaptability: {adaptability(player, matches):.4f}\n'
-
-    return res
-
-def player_stdev(player, matches: List[Result]) -> float:
-
-    filtered = filter(lambda x: x.contains(player), matches)
-    weighted_matches: List[float] = sum(
-            ([m.duration/m.game_count]*m.game_count for m in filtered), [])
-    return statistics.stdev(weighted_matches)
-
-def big_stats(matches : List[Result]):
-    big_dict = {}
-    for match in matches:
-        for player in match.players:
-            if player not in big_dict:
-                big_dict[player] = [match]
-            else:
-                big_dict[player].append(match)
-
-    sorted_players = sorted(big_dict.keys(), key=lambda x: len(big_dict[x]), reverse=True)
-
-    for player in sorted_players[:20]:
-        print(f'{player:17}, {format_duration(average(player, matches))}, '
-                f'{adaptability(player, matches):.4f}, '
-                f'{len(big_dict[player]):2}, '
-                f'{player_stdev(player, matches)/60:.2f}')
-
-def main(matches : List[Result]) -> None:
-
-    total_time = sum((m.duration for m in matches))
-    total_games = sum((m.game_count for m in matches))
-
-    print(f'Total games: {total_games}')
-    print(f'Total average: {format_duration(total_time/total_games)}')
-
-    weighted_matches: List[float] = sum(
-            ([m.duration/m.game_count]*m.game_count for m in matches), [])
-    print(f'stdev: {statistics.stdev(weighted_matches)/60:.2f}m')
-
-    match = max(matches, key=lambda x: x.duration)
-    print(f'Longest match: {format_duration(match.duration)} across {match.game_count}')
-
-    match = min(matches, key=lambda x: x.duration)
-    print(f'Shortest match: {format_duration(match.duration)} across {match.game_count}')
-
-    match = max(matches, key=lambda x: x.duration / x.game_count)
-    print(format_basic_stats('Longest average', match.duration, match.game_count))
-
-    match = min(matches, key=lambda x: x.duration / x.game_count)
-    print(format_basic_stats('Shortest average', match.duration, match.game_count))
-
-    print('Averages by tier:')
+    lines.append(f'Adaptability: {adaptability(player, database):.4f}')
+
+    return '\n'.join(lines) + '\n'
+
+def report_dependencies(player: str, database: Database) -> Set[str]:
+    """Players whose new results change the player_stats report of player,
+    i.e. the player and their opponents, whose averages go into adaptability."""
+    return {database.registry.canonical(player)} | {p
+            for match in database.matches_for(player) for p in match.players}
+
+def player_stdev(player, database: Database) -> float:
+    stats = WeightedStats()
+    stats.extend((m.duration/m.game_count, m.game_count)
+            for m in database.matches_for(player))
+    return stats.stdev
+
+@dataclass
+class PlayerTable:
+    players: List[str]
+    averages: numpy.ndarray
+    adaptability: numpy.ndarray
+    stdev: numpy.ndarray
+    match_counts: numpy.ndarray
+
+@perf.timed('statistics.player_table')
+def player_table(database: Database) -> PlayerTable:
+    """Average, adaptability, stdev and match count for every player, indexed
+    by player id in database.store.
+
+    Every match is counted once from each player's side, and the per-player
+    sums are grouped with bincount. Adaptability is the least squares slope,
+    the same as numpy.polyfit(x, y, 1)[0] in adaptability()."""
+    store = database.store
+    count = len(store.players)
+    match_averages = store.duration / store.game_count
+
+    player = numpy.concatenate((store.player_a, store.player_b))
+    opponent = numpy.concatenate((store.player_b, store.player_a))
+    values = numpy.concatenate((match_averages, match_averages))
+    weights = numpy.concatenate((store.game_count, store.game_count))
+
+    def grouped_sum(column: numpy.ndarray) -> numpy.ndarray:
+        return numpy.bincount(player, weights=column, minlength=count)
+
+    match_counts = numpy.bincount(player, minlength=count)
+    time, games = store.player_totals()
+    averages = time / games
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        stdev = numpy.sqrt(
+                grouped_sum(weights * (values - averages[player])**2) / (games - 1))
+
+        duration_diff = values / averages[player]
+        avg_diff = averages[opponent] / averages[player]
+        duration_mean = grouped_sum(duration_diff) / match_counts
+        avg_mean = grouped_sum(avg_diff) / match_counts
+        duration_centered = duration_diff - duration_mean[player]
+        slopes = (grouped_sum(duration_centered * (avg_diff - avg_mean[player]))
+                / grouped_sum(duration_centered**2))
+
+    return PlayerTable(store.players, averages, slopes, stdev, match_counts)
+
+@perf.timed('statistics.big_stats')
+def big_stats(database: Database, limit: Optional[int] = 20):
+    table = player_table(database)
+    sorted_players = numpy.argsort(-table.match_counts, kind='stable')
+
+    for player_id in sorted_players[:limit]:
+        print(f'{table.players[player_id]:17}, '
+                f'{format_duration(table.averages[player_id])}, '
+                f'{table.adaptability[player_id]:.4f}, '
+                f'{table.match_counts[player_id]:2}, '
+                f'{table.stdev[player_id]/60:.2f}')
+
+@perf.timed('statistics.summary')
+def summary(database: Database) -> str:
+    aggregates = database.aggregates
+    if not aggregates.total.games:
+        return 'No games found.'
+
+    total_time = aggregates.total.time
+    total_games = aggregates.total.games
+
+    lines = [f'Total games: {total_games}',
+            f'Total average: {format_duration(total_time/total_games)}',
+            f'stdev: {aggregates.averages.stdev/60:.2f}m']
+
+    match = aggregates.longest
+    lines.append(f'Longest match: {format_duration(match.duration)} across {match.game_count}')
+
+    match = aggregates.shortest
+    lines.append(f'Shortest match: {format_duration(match.duration)} across {match.game_count}')
+
+    match = aggregates.longest_average
+    lines.append(format_basic_stats('Longest average', match.duration, match.game_count))
+
+    match = aggregates.shortest_average
+    lines.append(format_basic_stats('Shortest average', match.duration, match.game_count))
+
+    lines.append('Averages by tier:')
     for tier in (chr(x) for x in range(65, 75)):
-        time = sum((m.duration for m in matches if tier in m.division))
-        games = sum((m.game_count for m in matches if tier in m.division))
-        print('\t', format_basic_stats(tier, time, games))
+        bucket = aggregates.tier(tier)
+        lines.append('\t ' + format_basic_stats(tier, bucket.time, bucket.games))
 
-    print('Average by game count:')
+    lines.append('Average by game count:')
     for count in range(1, 7):
-        time = sum((m.duration for m in matches if m.game_count == count))
-        games = sum((m.game_count for m in matches if m.game_count == count))
-        if not games:
-            continue
-        print('\t', format_basic_stats(str(count), time, games))
-
-def big_correlation(matches: List[Result]) -> None:
-    player_averages = []
-    durations = []
-    for match in matches:
-        if match.game_count < 3:
-            continue
-        if match.duration / match.game_count > 5000:
+        if count not in aggregates.game_counts:
             continue
-        avg = sum((average(p, matches) for p in match.players))/2
-        if avg > 2500:
-            continue
-        player_averages.append(avg)
-        durations.append(match.duration / match.game_count)
-
-    polyfit = numpy.polyfit(player_averages, durations, 1) # type: ignore
-    print(polyfit)
-    min_avg = min(player_averages)
-    max_avg = max(player_averages)
+        bucket = aggregates.game_counts[count]
+        lines.append('\t ' + format_basic_stats(str(count), bucket.time, bucket.games))
+
+    return '\n'.join(lines)
+
+def main(database: Database) -> None:
+    print(summary(database))
+
+def correlation_data(database: Database) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Average game duration of matches of 3+ games against the average of
+    the two players, and the line fitted through them. Raises ValueError if
+    there are no such matches."""
+    store = database.store
+    durations = store.duration / store.game_count
+    player_averages = store.player_averages()
+    pair_averages = (player_averages[store.player_a] + player_averages[store.player_b])/2
+
+    selected = ((store.game_count >= 3)
+            & (durations <= 5000)
+            & (pair_averages <= 2500))
+    pair_averages = pair_averages[selected]
+    durations = durations[selected]
+    if not len(durations): #pylint: disable=use-implicit-booleaness-not-len
+        raise ValueError('no matches to correlate')
+
+    polyfit = numpy.polyfit(pair_averages, durations, 1) # type: ignore
+    return pair_averages, durations, polyfit
+
+def draw_correlation(axes: Any, database: Database) -> numpy.ndarray:
+    """Plot correlation_data on matplotlib axes. Returns the fitted line."""
+    pair_averages, durations, polyfit = correlation_data(database)
+    min_avg = pair_averages.min()
+    max_avg = pair_averages.max()
     x_axis = numpy.linspace(min_avg, max_avg, 100)
     y_axis = x_axis*polyfit[0] + polyfit[1]
 
-    _fig, axes = pyplot.subplots()
-    axes.scatter(player_averages, durations, s=8, c='000000')
+    axes.scatter(pair_averages, durations, s=8, c='000000')
     axes.plot(x_axis, y_axis)
 
     axes.set_title(f'Game length as a function of players average game length. n={len(durations)}')
     axes.set_xlabel('average game duration for the two players')
     axes.set_ylabel('average game duration in the match')
-    pyplot.xlim(700, 2000)
-    pyplot.ylim(0, 3000)
+    axes.set_xlim(700, 2000)
+    axes.set_ylim(0, 3000)
+    return polyfit
+
+@perf.timed('statistics.big_correlation')
+def big_correlation(database: Database) -> None:
+    # matplotlib takes longer to import than the rest of the bot together,
+    # and only the plots need it
+    from matplotlib import pyplot #pylint: disable=import-outside-toplevel
+    _fig, axes = pyplot.subplots()
+    print(draw_correlation(axes, database))
     pyplot.show()
 
     #print(polyfit)
@@ -212,16 +281,16 @@ def big_correlation(matches: List[Result]) -> None:
     #        file.write(f'{avg},{duration}\n')
 
 def mainmain() -> None:
-    matches = load_matches()
-    main(matches)
+    database = load_database(sys.argv[1] if len(sys.argv) > 1 else None)
+    main(database)
     #print()
-    #print(player_stats('jakkdl', matches))
+    #print(player_stats('jakkdl', database))
     #print()
-    #print(player_stats('nasmith99', matches))
+    #print(player_stats('nasmith99', database))
     #print()
-    #print(player_stats('aku chi', matches))
-    big_stats(matches)
-    big_correlation(matches)
+    #print(player_stats('aku chi', database))
+    big_stats(database)
+    big_correlation(database)
 
 if __name__ == '__main__':
     mainmain()
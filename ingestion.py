@@ -0,0 +1,84 @@
+"""Queue between the gateway event handler and the database.
+
+on_message only puts #matches and #results messages on a bounded queue, and a
+worker task parses them in batches, yielding to the event loop between batches
+so heartbeats and DM commands aren't held up by a burst of results.
+"""
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+import discord  # type: ignore
+
+import discord_commands as commands
+import perf
+
+QUEUE_SIZE = 1000
+BATCH_SIZE = 50
+
+
+class IngestionQueue:
+    def __init__(self, maxsize: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        self.processed = 0
+        self.batches = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        """Start the worker, if it isn't running. Must be called from the
+        event loop."""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def put(self, message: discord.Message) -> None:
+        """Waits while the queue is full, which pushes back on the gateway."""
+        self.start()
+        assert self._queue is not None
+        await self._queue.put((time.monotonic(), message))
+
+    @property
+    def depth(self) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def join(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+
+    def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _run(self) -> None:
+        assert self._queue is not None
+        while True:
+            batch: List[Tuple[float, discord.Message]] = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            for queued_at, message in batch:
+                try:
+                    commands.parse_live_message(message)
+                except Exception as error: #pylint: disable=broad-except
+                    print(f'Failed to ingest message {message.id}: {error!r}')
+                finally:
+                    self._queue.task_done()
+                self.last_lag = time.monotonic() - queued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+                perf.record('ingestion.lag', self.last_lag)
+
+            self.processed += len(batch)
+            self.batches += 1
+            await asyncio.sleep(0)
+
+    def status(self) -> str:
+        return (f'queue depth: {self.depth}/{self.maxsize}\n'
+                f'processed: {self.processed} messages in {self.batches} batches\n'
+                f'lag: {self.last_lag*1000:.1f}ms last, {self.max_lag*1000:.1f}ms max')
@@ -0,0 +1,63 @@
+"""Append-only JSON lines log of database mutations.
+
+Every record is flushed to the OS as it's written, so it survives the bot
+crashing. To survive a crash of the whole machine it also has to reach the
+disk, which happens with the first record written SYNC_INTERVAL seconds
+after the last fsync, and on close. Records appended since then are lost
+if the machine goes down."""
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, Optional, TextIO
+
+Record = Dict[str, Any]
+
+SYNC_INTERVAL = 1.0
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+        self.records = 0
+        self._file: Optional[TextIO] = None
+        self._synced = time.monotonic()
+
+    def append(self, record: Record) -> None:
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8') #pylint: disable=consider-using-with
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.records += 1
+        if time.monotonic() - self._synced >= SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self) -> None:
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def replay(self) -> Iterator[Record]:
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a crash in the middle of a write leaves a partial last line
+                    print(f'Skipping corrupt journal line in {self.path}: {line!r}')
+                    continue
+                self.records += 1
+                yield record
+
+    def truncate(self) -> None:
+        self.close()
+        with open(self.path, 'w', encoding='utf-8'):
+            pass
+        self.records = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,196 @@
+"""Columnar NumPy copy of the results in a Database, for vectorized statistics."""
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy #type: ignore
+
+from seat_typing import Result, division_code
+from player_registry import names
+
+COLUMNS = {
+    'start_time': numpy.int64,
+    'duration': numpy.int64,
+    'game_count': numpy.int64,
+    'division': numpy.int32,
+    'player_a': numpy.int32,
+    'player_b': numpy.int32,
+}
+
+class MatchStore:
+    def __init__(self, capacity: int = 1024):
+        self._size = 0
+        self._columns: Dict[str, numpy.ndarray] = {}
+
+        self.players: List[str] = []
+        self.player_ids: Dict[str, int] = {}
+
+        self.divisions: List[str] = []
+        self.division_ids: Dict[str, int] = {}
+
+        self.clear(capacity)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _column(self, name: str) -> numpy.ndarray:
+        return self._columns[name][:self._size]
+
+    @property
+    def start_time(self) -> numpy.ndarray:
+        return self._column('start_time')
+
+    @property
+    def duration(self) -> numpy.ndarray:
+        return self._column('duration')
+
+    @property
+    def game_count(self) -> numpy.ndarray:
+        return self._column('game_count')
+
+    @property
+    def division(self) -> numpy.ndarray:
+        return self._column('division')
+
+    @property
+    def player_a(self) -> numpy.ndarray:
+        return self._column('player_a')
+
+    @property
+    def player_b(self) -> numpy.ndarray:
+        return self._column('player_b')
+
+    def player_id(self, player: str) -> int:
+        if player not in self.player_ids:
+            self.player_ids[player] = len(self.players)
+            self.players.append(player)
+        return self.player_ids[player]
+
+    def division_id(self, division: str) -> int:
+        if division not in self.division_ids:
+            self.division_ids[division] = len(self.divisions)
+            self.divisions.append(division)
+        return self.division_ids[division]
+
+    def divisions_containing(self, tier: str) -> List[int]:
+        return [i for i, division in enumerate(self.divisions) if tier in division]
+
+    def _grow(self, needed: int) -> None:
+        capacity = len(self._columns['duration'])
+        if needed <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        for name, column in self._columns.items():
+            # this also copies columns that are read-only views of a snapshot
+            grown = numpy.empty(capacity, dtype=COLUMNS[name])
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+
+    def append(self, result: Result) -> None:
+        self._grow(self._size + 1)
+        index = self._size
+        self._columns['start_time'][index] = result.start_epoch
+        self._columns['duration'][index] = result.duration
+        self._columns['game_count'][index] = result.game_count
+        self._columns['division'][index] = self.division_id(result.division)
+        self._columns['player_a'][index] = self.player_id(result.players[0])
+        self._columns['player_b'][index] = self.player_id(result.players[1])
+        self._size += 1
+
+    def extend(self, results: Iterable[Result]) -> None:
+        for result in results:
+            self.append(result)
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, numpy.ndarray],
+            players: List[str], divisions: List[str]) -> 'MatchStore':
+        """Wrap existing equal-length columns without copying them."""
+        store = cls(capacity=0)
+        store._columns = dict(columns)
+        store._size = len(columns['duration'])
+        store.players = list(players)
+        store.player_ids = {player: i for i, player in enumerate(players)}
+        store.divisions = list(divisions)
+        store.division_ids = {division: i for i, division in enumerate(divisions)}
+        return store
+
+    def view(self) -> 'MatchStore':
+        """Share the columns as they are now. Rows are never changed once
+        appended, so later appends don't show up in the view."""
+        return MatchStore.from_columns(
+                {name: self._column(name) for name in COLUMNS},
+                self.players, self.divisions)
+
+    @classmethod
+    def concatenate(cls, stores: Sequence['MatchStore']) -> 'MatchStore':
+        """One store with the rows of all stores, in order."""
+        players: Dict[str, int] = {}
+        divisions: Dict[str, int] = {}
+        parts: Dict[str, List[numpy.ndarray]] = {name: [] for name in COLUMNS}
+        for store in stores:
+            player_map = numpy.array([players.setdefault(player, len(players))
+                for player in store.players], dtype=COLUMNS['player_a'])
+            division_map = numpy.array([divisions.setdefault(division, len(divisions))
+                for division in store.divisions], dtype=COLUMNS['division'])
+            for name in ('start_time', 'duration', 'game_count'):
+                parts[name].append(store._column(name)) #pylint: disable=protected-access
+            parts['division'].append(division_map[store.division])
+            parts['player_a'].append(player_map[store.player_a])
+            parts['player_b'].append(player_map[store.player_b])
+        columns = {name: numpy.concatenate(parts[name]).astype(dtype, copy=False)
+                if parts[name] else numpy.empty(0, dtype=dtype)
+                for name, dtype in COLUMNS.items()}
+        return cls.from_columns(columns, list(players), list(divisions))
+
+    def copy(self) -> 'MatchStore':
+        return MatchStore.from_columns(
+                {name: numpy.array(self._column(name), dtype=dtype)
+                    for name, dtype in COLUMNS.items()},
+                self.players, self.divisions)
+
+    def result(self, index: int) -> Result:
+        return Result.from_codes(
+                names.pair((self.players[self.player_a[index]],
+                    self.players[self.player_b[index]])),
+                int(self.start_time[index]),
+                int(self.duration[index]),
+                int(self.game_count[index]),
+                division_code(self.divisions[self.division[index]]))
+
+    def results(self) -> List[Result]:
+        # interned id and division code of every player and division of the store
+        ids = [names.intern(player) for player in self.players]
+        codes = [division_code(division) for division in self.divisions]
+        return [Result.from_codes(names.order(ids[a], ids[b]), start, duration, games,
+                    codes[division])
+                for start, duration, games, division, a, b in zip(
+                    self.start_time.tolist(), self.duration.tolist(),
+                    self.game_count.tolist(), self.division.tolist(),
+                    self.player_a.tolist(), self.player_b.tolist())]
+
+    def clear(self, capacity: int = 1024) -> None:
+        self._size = 0
+        self._columns = {name: numpy.empty(capacity, dtype=dtype)
+                for name, dtype in COLUMNS.items()}
+        self.players = []
+        self.player_ids = {}
+        self.divisions = []
+        self.division_ids = {}
+
+    def player_totals(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Summed duration and game count per player id."""
+        count = len(self.players)
+        time = (numpy.bincount(self.player_a, weights=self.duration, minlength=count)
+                + numpy.bincount(self.player_b, weights=self.duration, minlength=count))
+        games = (numpy.bincount(self.player_a, weights=self.game_count, minlength=count)
+                + numpy.bincount(self.player_b, weights=self.game_count, minlength=count))
+        return time, games
+
+    def player_averages(self) -> numpy.ndarray:
+        time, games = self.player_totals()
+        return time / games
+
+    def player_match_counts(self) -> numpy.ndarray:
+        count = len(self.players)
+        return (numpy.bincount(self.player_a, minlength=count)
+                + numpy.bincount(self.player_b, minlength=count))
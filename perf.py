@@ -0,0 +1,156 @@
+"""Lightweight timing of the bot's hot paths.
+
+`timed(name)` works as a decorator, on plain and async functions, and as a
+context manager. Every timed section keeps a call count, total time and a
+log-scale latency histogram, cheap enough to leave on in production.
+"""
+import asyncio
+import functools
+import json
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+FuncT = TypeVar('FuncT', bound=Callable[..., Any])
+
+# bucket i holds latencies up to MIN_LATENCY * GROWTH**(i+1)
+MIN_LATENCY = 1e-6
+GROWTH = 1.25
+BUCKETS = 110 # up to about 4.5 hours
+
+DUMP_FILE = 'perf.json'
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        if seconds <= MIN_LATENCY:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / MIN_LATENCY, GROWTH)), BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: 'Histogram') -> None:
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of calls."""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(MIN_LATENCY * GROWTH ** (index + 1), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+timings: Dict[str, Histogram] = {}
+
+def record(name: str, seconds: float) -> None:
+    if name not in timings:
+        timings[name] = Histogram()
+    timings[name].add(seconds)
+
+def merge(other: Dict[str, Histogram]) -> None:
+    """Add timings recorded somewhere else, like a worker process."""
+    for name, histogram in other.items():
+        if name not in timings:
+            timings[name] = Histogram()
+        timings[name].merge(histogram)
+
+def drain() -> Dict[str, Histogram]:
+    """The timings recorded so far, which are then cleared."""
+    drained = dict(timings)
+    timings.clear()
+    return drained
+
+
+class timed: #pylint: disable=invalid-name
+    def __init__(self, name: str):
+        self.name = name
+        self._start: List[float] = []
+
+    def __enter__(self) -> 'timed':
+        self._start.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        record(self.name, time.perf_counter() - self._start.pop())
+
+    def __call__(self, function: FuncT) -> FuncT:
+        name = self.name
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    record(name, time.perf_counter() - start)
+            return async_wrapper # type: ignore
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper # type: ignore
+
+
+def _format_latency(seconds: float) -> str:
+    if seconds >= 1:
+        return f'{seconds:.2f}s'
+    return f'{seconds*1000:.1f}ms'
+
+def report(prefix: Optional[str] = None) -> str:
+    if not timings:
+        return 'No timings recorded yet.'
+    lines = []
+    for name, histogram in sorted(timings.items(), key=lambda x: -x[1].total):
+        if prefix is not None and not name.startswith(prefix):
+            continue
+        lines.append(f'{name}: {histogram.count} calls, '
+                f'p50 {_format_latency(histogram.percentile(0.50))}, '
+                f'p95 {_format_latency(histogram.percentile(0.95))}, '
+                f'p99 {_format_latency(histogram.percentile(0.99))}, '
+                f'max {_format_latency(histogram.max)}')
+    return '\n'.join(lines) if lines else f'No timings matching {prefix}.'
+
+def dump(filename: str = DUMP_FILE) -> None:
+    with open(filename, 'w', encoding='utf-8') as file:
+        json.dump({name: histogram.summary() for name, histogram in timings.items()},
+                file, indent=2)
+
+async def dump_periodically(interval: float, filename: str = DUMP_FILE) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        dump(filename)
+
+def reset() -> None:
+    timings.clear()
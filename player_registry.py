@@ -0,0 +1,119 @@
+"""Interned player identities.
+
+Names are normalized once when they're first seen and mapped to small
+integer ids, which Results and the Database indexes store instead of
+strings. The ids are shared by every shard of the database, so results of
+different guilds can be merged, but the aliases aren't: each guild's
+PlayerRegistry maps another name, e.g. after an account is renamed, to the
+name the player is stored under in that guild. If the alias already has
+matches of its own, because the account has played under its new name
+before the alias was added, the two players are merged and whatever stores
+their ids has to re-key it.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PlayerIds = Tuple[int, int]
+
+
+def normalize(name: str) -> str:
+    return name.lower()
+
+
+class PlayerNames:
+    def __init__(self) -> None:
+        # normalized name of every id
+        self.names: List[str] = []
+        # normalized name -> id
+        self.ids: Dict[str, int] = {}
+        self._pairs: Dict[PlayerIds, PlayerIds] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def intern(self, name: str) -> int:
+        name = normalize(name)
+        player_id = self.ids.get(name)
+        if player_id is None:
+            player_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = player_id
+        return player_id
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Id of a known name, without registering unknown names."""
+        return self.ids.get(normalize(name))
+
+    def name(self, player_id: int) -> str:
+        return self.names[player_id]
+
+    def pair(self, players: Iterable[str]) -> PlayerIds:
+        """Ids of the two players, ordered by name like pairings are stored."""
+        first, second = (self.intern(player) for player in players)
+        return self.order(first, second)
+
+    def order(self, first: int, second: int) -> PlayerIds:
+        # every Result of a pairing shares the same tuple
+        key = (first, second)
+        pair = self._pairs.get(key)
+        if pair is None:
+            pair = (second, first) if self.names[second] < self.names[first] else key
+            self._pairs[key] = pair
+        return pair
+
+    def pair_names(self, player_ids: PlayerIds) -> Tuple[str, str]:
+        return (self.names[player_ids[0]], self.names[player_ids[1]])
+
+names = PlayerNames()
+
+
+class PlayerRegistry:
+    """The aliases of one shard of the database, over the shared names."""
+    def __init__(self) -> None:
+        # normalized alias -> canonical name
+        self.aliases: Dict[str, str] = {}
+
+    def canonical(self, name: str) -> str:
+        """Normalized name the player is stored under."""
+        name = normalize(name)
+        return self.aliases.get(name, name)
+
+    def intern(self, name: str) -> int:
+        return names.intern(self.canonical(name))
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Id of a known player, without registering unknown names."""
+        return names.lookup(self.canonical(name))
+
+    def name(self, player_id: int) -> str:
+        return names.name(player_id)
+
+    def pair(self, players: Iterable[str]) -> PlayerIds:
+        """Ids of the two players, ordered by name like pairings are stored."""
+        first, second = (self.intern(player) for player in players)
+        return names.order(first, second)
+
+    def pair_names(self, player_ids: PlayerIds) -> Tuple[str, str]:
+        return names.pair_names(player_ids)
+
+    def add_alias(self, alias: str, name: str) -> int:
+        """Make alias refer to the player called name. If alias is a player
+        of its own, that player and its aliases are merged into name.
+        Raises ValueError if alias is already an alias of a different player."""
+        alias = normalize(alias)
+        canonical = self.canonical(name)
+        if alias in self.aliases and self.aliases[alias] != canonical:
+            raise ValueError(f'{alias} is already an alias of {self.aliases[alias]}')
+        if alias != canonical:
+            # the aliases of a merged player now lead to the one it was merged into
+            for key, value in self.aliases.items():
+                if value == alias:
+                    self.aliases[key] = canonical
+            self.aliases[alias] = canonical
+        return names.intern(canonical)
+
+    def merges(self, alias: str, name: str) -> bool:
+        """Whether add_alias(alias, name) would merge two players. It may
+        also be true if alias only played in another shard."""
+        alias = normalize(alias)
+        return (alias not in self.aliases and names.lookup(alias) is not None
+                and alias != self.canonical(name))
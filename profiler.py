@@ -0,0 +1,140 @@
+"""On demand cProfile capture of the live bot.
+
+Nothing is profiled unless an admin starts a session with !profile. A session
+profiles everything on the event loop, and the jobs StatsPool workers run in
+the meantime, until either a number of commands have finished or a number of
+seconds have passed. It then writes the .pstats file to PROFILE_DIR and DMs a
+summary of the top functions by cumulative time.
+"""
+import asyncio
+import cProfile
+import datetime
+import os
+import os.path
+import pstats
+from typing import List, Optional
+
+from seat_typing import DiscordUser
+
+PROFILE_DIR = 'profiles'
+TOP_FUNCTIONS = 20
+MESSAGE_LIMIT = 1900
+
+
+class ProfileSession:
+    def __init__(self, owner: DiscordUser,
+            commands: Optional[int] = None,
+            seconds: Optional[float] = None,
+            directory: str = PROFILE_DIR):
+        self.owner = owner
+        self.commands_left = commands
+        self.seconds = seconds
+        self.directory = directory
+        self.started = datetime.datetime.now()
+        self.profile = cProfile.Profile()
+        # stats saved by StatsPool workers for jobs run during the session
+        self.worker_profiles: List[str] = []
+        self._timer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        # raises ValueError if another profiler, e.g. a debugger, is active
+        self.profile.enable()
+        if self.seconds is not None:
+            self._timer = asyncio.create_task(self._stop_after(self.seconds))
+
+    async def _stop_after(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        await stop()
+
+    def command_finished(self) -> bool:
+        """Returns whether that was the last command to profile."""
+        if self.commands_left is None:
+            return False
+        self.commands_left -= 1
+        return self.commands_left <= 0
+
+    def finish(self) -> str:
+        """Stop profiling and save the stats. Returns the file name."""
+        self.profile.disable()
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory,
+                f"profile-{self.started.strftime('%Y%m%d-%H%M%S-%f')}.pstats")
+        self.profile.dump_stats(filename)
+        if self.worker_profiles:
+            stats = pstats.Stats(filename)
+            for worker_profile in self.worker_profiles:
+                stats.add(worker_profile)
+                os.remove(worker_profile)
+            stats.dump_stats(filename)
+        return filename
+
+    def describe(self) -> str:
+        if self.commands_left is not None:
+            return f'the next {self.commands_left} commands'
+        return f'{self.seconds:g} seconds'
+
+
+def summarize(filename: str, top: int = TOP_FUNCTIONS) -> str:
+    stats = pstats.Stats(filename)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    lines = [f'{"cumtime":>9} {"tottime":>9} {"calls":>8}  function']
+    for function in stats.fcn_list[:top]: # type: ignore
+        _, calls, tottime, cumtime, _ = stats.stats[function] # type: ignore
+        path, line, name = function
+        location = f'{os.path.basename(path)}:{line}({name})' if line else name
+        lines.append(f'{cumtime:8.3f}s {tottime:8.3f}s {calls:8}  {location}')
+    return '\n'.join(lines)
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Split on line breaks into code blocks that fit in a discord message."""
+    chunks: List[str] = []
+    current: List[str] = []
+    length = 0
+    for line in text.split('\n'):
+        line = line[:limit]
+        if current and length + len(line) + 1 > limit:
+            chunks.append('\n'.join(current))
+            current, length = [], 0
+        current.append(line)
+        length += len(line) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return [f'```\n{chunk}\n```' for chunk in chunks]
+
+
+session: Optional[ProfileSession] = None
+
+def start(new_session: ProfileSession) -> None:
+    global session #pylint: disable=global-statement
+    if session is not None:
+        raise ValueError(f'already profiling {session.describe()}')
+    new_session.start()
+    session = new_session
+
+async def stop() -> Optional[str]:
+    """End the current session, if any, and DM its summary to whoever started
+    it. Returns the stats file name."""
+    global session #pylint: disable=global-statement
+    if session is None:
+        return None
+    finished, session = session, None
+    filename = finished.finish()
+    await finished.owner.send(f'profile saved to {filename}')
+    for chunk in split_message(summarize(filename)):
+        await finished.owner.send(chunk)
+    return filename
+
+def add_worker_profile(profiled: Optional[ProfileSession], filename: str) -> None:
+    """Merge stats a worker saved while profiled was the session into its
+    results, or delete them if that session has already finished."""
+    if profiled is not None and profiled is session:
+        profiled.worker_profiles.append(filename)
+    else:
+        os.remove(filename)
+
+async def command_finished(profiled: Optional[ProfileSession]) -> None:
+    """Called after each command that ran while profiled was the session."""
+    if profiled is not None and profiled is session and profiled.command_finished():
+        await stop()
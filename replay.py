@@ -0,0 +1,78 @@
+#!env/bin/python3
+"""Rebuild a database offline by replaying an archive of #matches/#results
+messages through the same parse functions the bot uses.
+
+See archive.py for the archive format; the !archive command records one.
+Usage: replay.py ARCHIVE [--output DIR] [--save] [--repeat N]
+
+Every pass replays into an empty database in a temporary directory that's
+removed afterwards, and without a journal. With --save, the last pass
+replays into --output instead, journaled, and saves a snapshot there.
+"""
+import argparse
+import contextlib
+import tempfile
+import time
+from typing import Dict, List
+
+import discord_commands as commands
+from archive import ArchivedMessage, read_archive
+from database import Database
+from sharded_database import ShardedDatabase
+
+
+def replay(messages: List[ArchivedMessage], database: ShardedDatabase) -> Dict[str, float]:
+    """Parse messages into database, in time order like !update, and time it."""
+    commands.database = database
+
+    matches_parsed, results_parsed = 0, 0
+    start = time.perf_counter()
+    for message in messages:
+        if message.channel.name == 'matches':
+            if commands.parse_matches_message(message):
+                matches_parsed += 1
+        elif commands.parse_results_message(message):
+            results_parsed += 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        'messages': len(messages),
+        'matches': matches_parsed,
+        'results': results_parsed,
+        'seconds': elapsed,
+        'messages_per_second': len(messages) / elapsed if elapsed else float('inf'),
+    }
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('archive')
+    parser.add_argument('--output', help='directory to --save the rebuilt database to '
+            '(default: a new temporary directory)')
+    parser.add_argument('--save', action='store_true',
+            help='write a snapshot of the rebuilt database to the output directory')
+    parser.add_argument('--repeat', type=int, default=1,
+            help='replay into a fresh database this many times, for load testing')
+    args = parser.parse_args()
+
+    messages = sorted(read_archive(args.archive), key=lambda m: m.created_at)
+    for repetition in range(args.repeat):
+        last = repetition == args.repeat - 1
+        with contextlib.ExitStack() as stack:
+            save = args.save and last
+            if save:
+                directory = args.output or tempfile.mkdtemp(prefix='dominion_replay_')
+            else:
+                directory = stack.enter_context(
+                        tempfile.TemporaryDirectory(prefix='dominion_replay_'))
+            database = ShardedDatabase(
+                    lambda shard, save=save: Database(shard, journaling=save), directory)
+            stats = replay(messages, database)
+            print(f"{stats['messages']} messages in {stats['seconds']:.3f}s "
+                  f"({stats['messages_per_second']:.0f}/s): "
+                  f"{stats['matches']} matches, {stats['results']} results")
+            if save:
+                database.save()
+                print(f'saved to {database.directory}')
+
+if __name__ == '__main__':
+    _main()
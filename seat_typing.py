@@ -5,11 +5,12 @@ import asyncio
 import typing
 import datetime
 
-from dataclasses import dataclass
 from enum import Enum, auto
 
 import discord  # type: ignore
 
+from player_registry import PlayerIds, names
+
 DiscordChannel = typing.Union[discord.TextChannel,
                               discord.DMChannel]
 
@@ -19,13 +20,93 @@ class SeatException(Exception):
 
 Players = typing.Tuple[str, str]
 
-@dataclass
+def to_epoch(time: datetime.datetime) -> int:
+    # discord hands out naive UTC timestamps
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return int(time.timestamp())
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def from_epoch(epoch: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(seconds=epoch)
+
+# divisions are interned to small codes, there's only a handful of them
+DIVISIONS: typing.List[str] = []
+DIVISION_CODES: typing.Dict[str, int] = {}
+
+def division_code(division: str) -> int:
+    code = DIVISION_CODES.get(division)
+    if code is None:
+        code = DIVISION_CODES[division] = len(DIVISIONS)
+        DIVISIONS.append(division)
+    return code
+
+
 class Result:
-    players: Players
-    start_time: datetime.datetime
-    duration: int
-    game_count: int
-    division: str
+    """A finished match. Stored compactly, as there's one per match ever
+    played: the players as interned ids, the start as a UTC epoch and the
+    division as a code. The other attributes are computed on access."""
+    __slots__ = ('player_ids', 'start_epoch', 'duration', 'game_count', 'division_code')
+
+    def __init__(self, player_ids: PlayerIds, #pylint: disable=too-many-arguments
+            start_time: datetime.datetime,
+            duration: int,
+            game_count: int,
+            division: str):
+        self.player_ids = player_ids
+        self.start_epoch = to_epoch(start_time)
+        self.duration = duration
+        self.game_count = game_count
+        self.division_code = division_code(division)
+
+    @classmethod
+    def from_names(cls, players: Players, start_time: datetime.datetime,
+            duration: int, game_count: int, division: str) -> Result:
+        return cls(names.pair(players), start_time, duration, game_count, division)
+
+    @classmethod
+    def from_codes(cls, player_ids: PlayerIds, #pylint: disable=too-many-arguments
+            start_epoch: int,
+            duration: int,
+            game_count: int,
+            code: int) -> Result:
+        """Without converting anything, for bulk loads."""
+        result = cls.__new__(cls)
+        result.player_ids = player_ids
+        result.start_epoch = start_epoch
+        result.duration = duration
+        result.game_count = game_count
+        result.division_code = code
+        return result
+
+    @property
+    def players(self) -> Players:
+        return names.pair_names(self.player_ids)
+
+    @property
+    def start_time(self) -> datetime.datetime:
+        return from_epoch(self.start_epoch)
+
+    @property
+    def division(self) -> str:
+        return DIVISIONS[self.division_code]
+
+    def _key(self) -> typing.Tuple[PlayerIds, int, int, int, int]:
+        return (self.player_ids, self.start_epoch, self.duration, self.game_count,
+                self.division_code)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Result):
+            return NotImplemented
+        return self._key() == other._key()
+
+    __hash__ = None # type: ignore
+
+    def __repr__(self) -> str:
+        return (f'Result(players={self.players!r}, start_time={self.start_time!r}, '
+                f'duration={self.duration!r}, game_count={self.game_count!r}, '
+                f'division={self.division!r})')
 
     def __str__(self) -> str:
         return ','.join((str(x) for x in (*self.players,
@@ -35,7 +116,19 @@ class Result:
                 self.division)))
 
     def contains(self, player: str) -> bool:
-        return player.lower() in map(lambda x: x.lower(), self.players)
+        return names.lookup(player) in self.player_ids
+
+    # ids and codes are only meaningful within one process, so pickles hold
+    # the names
+
+    def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+        return (Result.from_names, (self.players, self.start_time, self.duration,
+            self.game_count, self.division))
+
+    def __setstate__(self, state: typing.Dict[str, typing.Any]) -> None:
+        # pickled as a dataclass holding the names by older versions
+        Result.__init__(self, names.pair(state['players']), state['start_time'],
+                state['duration'], state['game_count'], state['division'])
 
 # mypy-annotation-for-classmethod-returning-instance
 # https://stackoverflow.com/questions/44640479/
@@ -205,8 +298,9 @@ class DiscordUser:
     def display_name(self) -> str:
         return self.user.display_name  # type: ignore
 
-    async def send(self, message: str) -> None:
-        await self.user.send(message)
+    async def send(self, message: typing.Optional[str] = None,
+            file: typing.Optional[discord.File] = None) -> None:
+        await self.user.send(message, file=file)
 
     @property
     def is_admin(self) -> bool:
@@ -0,0 +1,149 @@
+"""One database per discord guild, so leagues on different servers don't
+mix their players, divisions and checkpoints.
+
+Each shard is an ordinary Database (or SqliteDatabase) in a directory of its
+own and is only loaded the first time it's used. The data of a bot from
+before sharding, and of messages that aren't in a guild, stays in the
+top-level directory as the shard of guild None.
+
+Every shard has aliases of its own, as the same name can be different
+players in different leagues. The bot only asks the shard of the guild a
+command comes from, so the other shards stay unloaded. For the offline
+statistics, queries about players or the whole history fan out to every
+shard, loading them all, and merge the results, so the statistics code can
+use a ShardedDatabase in place of a Database. Players are merged by the
+name each shard stores them under.
+"""
+import os
+import os.path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from seat_typing import Result
+from match_store import MatchStore
+from aggregates import MatchAggregates
+from cache import LRUCache
+from player_registry import PlayerRegistry
+import perf
+
+GUILDS_DIRECTORY = 'guilds'
+
+GuildId = Optional[int]
+
+
+class ShardedDatabase:
+    def __init__(self, open_shard: Callable[[str], Any], directory: str = '.'):
+        """open_shard(directory) returns an unloaded shard stored there."""
+        self.open_shard = open_shard
+        self.directory = directory
+        self._shards: Dict[GuildId, Any] = {}
+
+        # the shards' aliases are already applied to their results
+        self.registry = PlayerRegistry()
+        # (player, version) -> average game length
+        self.averages: LRUCache[Tuple[str, int], float] = LRUCache(maxsize=1024)
+        self._store: Optional[MatchStore] = None
+        self._store_version = -1
+        self._aggregates: Optional[MatchAggregates] = None
+        self._aggregates_version = -1
+
+    def shard_directory(self, guild_id: GuildId) -> str:
+        if guild_id is None:
+            return self.directory
+        return os.path.join(self.directory, GUILDS_DIRECTORY, str(guild_id))
+
+    def _saved_guilds(self) -> List[int]:
+        try:
+            entries = os.listdir(os.path.join(self.directory, GUILDS_DIRECTORY))
+        except FileNotFoundError:
+            return []
+        return [int(entry) for entry in entries if entry.isdigit()]
+
+    def shard(self, guild_id: GuildId) -> Any:
+        """The shard of a guild, loaded from disk the first time it's used."""
+        if guild_id not in self._shards:
+            directory = self.shard_directory(guild_id)
+            os.makedirs(directory, exist_ok=True)
+            shard = self.open_shard(directory)
+            shard.load()
+            self._shards[guild_id] = shard
+        return self._shards[guild_id]
+
+    def shards(self) -> List[Tuple[GuildId, Any]]:
+        """Every shard, loading those saved on disk that aren't yet."""
+        for guild_id in [None, *self._saved_guilds()]:
+            self.shard(guild_id)
+        return sorted(self._shards.items(), key=lambda x: -1 if x[0] is None else x[0])
+
+    def _all(self) -> Iterator[Any]:
+        return (shard for _, shard in self.shards())
+
+    @property
+    def version(self) -> int:
+        """Changes whenever the results of any shard do."""
+        return sum(shard.version for shard in self._shards.values())
+
+    def matches_for(self, player: str) -> List[Result]:
+        return [match for shard in self._all() for match in shard.matches_for(player)]
+
+    def player_totals(self, player: str) -> Tuple[int, int]:
+        time, games = 0, 0
+        for shard in self._all():
+            shard_time, shard_games = shard.player_totals(player)
+            time += shard_time
+            games += shard_games
+        return time, games
+
+    @property
+    def flat_matches(self) -> List[Result]:
+        return [match for shard in self._all() for match in shard.flat_matches]
+
+    @property
+    def checkpoints(self) -> Dict[int, int]:
+        # channel ids are unique across guilds
+        return {channel: message
+                for shard in self._all() for channel, message in shard.checkpoints.items()}
+
+    @property
+    def store(self) -> MatchStore:
+        shards = list(self._all())
+        if self._store is None or self._store_version != self.version:
+            self._store = MatchStore.concatenate([shard.store for shard in shards])
+            self._store_version = self.version
+        return self._store
+
+    @property
+    def aggregates(self) -> MatchAggregates:
+        """Merged from the running totals of the shards, without going
+        through their results."""
+        shards = list(self._all())
+        if self._aggregates is None or self._aggregates_version != self.version:
+            self._aggregates = MatchAggregates.combine(shard.aggregates for shard in shards)
+            self._aggregates_version = self.version
+        return self._aggregates
+
+    def print_matches(self, data: str = 'all') -> None:
+        for guild_id, shard in self.shards():
+            print(f'guild {guild_id}:')
+            shard.print_matches(data)
+
+    @perf.timed('database.save')
+    def save(self) -> None:
+        """Only the shards that have been loaded can have changed."""
+        for shard in self._shards.values():
+            shard.save()
+
+    @perf.timed('database.load')
+    def load(self) -> None:
+        """Reload the shards that have been loaded, the others are loaded
+        when they're first used."""
+        for shard in self._shards.values():
+            shard.load()
+
+    def close(self) -> None:
+        """Sync the journals of the loaded shards, on shutdown."""
+        for shard in self._shards.values():
+            shard.close()
+
+    def wipe(self, data: str = 'all') -> None:
+        for shard in self._all():
+            shard.wipe(data)
@@ -0,0 +1,382 @@
+"""Database backend on sqlite3, with the same interface as database.Database.
+
+Pending matches and results live on disk, and the per-player and summary
+statistics are answered by indexed SQL queries instead of in-memory lists.
+Select it by setting DATABASE_BACKEND=sqlite before starting the bot.
+"""
+from __future__ import annotations
+
+import datetime
+import sqlite3
+import typing
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from seat_typing import Result, Players, from_epoch, to_epoch
+from player_registry import PlayerRegistry, normalize
+from match_store import MatchStore
+from export import ExportFilter, export_csv
+from cache import LRUCache, ReportCache
+from aggregates import Bucket, MatchAggregates
+from weighted_stats import WeightedStats
+import perf
+
+if typing.TYPE_CHECKING:
+    # pylint: disable=cyclic-import
+    from database import Database
+
+ADJACENT_WINDOW = 10 * 60
+MATCH_WINDOW = 6 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pending (
+    player_a TEXT NOT NULL,
+    player_b TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    deadline INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_pair ON pending (player_a, player_b, start_time);
+CREATE INDEX IF NOT EXISTS pending_deadline ON pending (deadline);
+
+CREATE TABLE IF NOT EXISTS results (
+    player_a TEXT NOT NULL,
+    player_b TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    game_count INTEGER NOT NULL,
+    division TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_pair ON results (player_a, player_b, start_time);
+CREATE INDEX IF NOT EXISTS results_player_a ON results (player_a);
+CREATE INDEX IF NOT EXISTS results_player_b ON results (player_b);
+CREATE INDEX IF NOT EXISTS results_end ON results (start_time + duration);
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+    channel_id INTEGER PRIMARY KEY,
+    message_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+'''
+
+RESULT_COLUMNS = 'player_a, player_b, start_time, duration, game_count, division'
+
+def _result(row: Tuple) -> Result:
+    player_a, player_b, start_time, duration, game_count, division = row
+    return Result.from_names((player_a, player_b), from_epoch(start_time),
+            duration, game_count, division)
+
+
+class SqliteDatabase:
+    def __init__(self, path: str = 'matches.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        # the aliases of this shard's players
+        self.registry = PlayerRegistry()
+        for alias, name in self.connection.execute('SELECT alias, name FROM aliases'):
+            self.registry.add_alias(alias, name)
+
+        self.version = 0
+        # (player, version) -> average game length
+        self.averages: LRUCache[Tuple[str, int], float] = LRUCache(maxsize=1024)
+        self.reports = ReportCache()
+        self._store: Optional[MatchStore] = None
+        self._store_version = -1
+        self._aggregates: Optional[MatchAggregates] = None
+        self._aggregates_version = -1
+
+    def _changed(self, players: Iterable[str] = ()) -> None:
+        self.version += 1
+        self.reports.invalidate(players)
+
+    def _latest_result(self) -> Optional[int]:
+        row = self.connection.execute(
+                'SELECT MAX(start_time + duration) FROM results').fetchone()
+        return row[0]
+
+    def _deadline(self, start_time: int) -> int:
+        # see Database._deadline
+        latest = self._latest_result()
+        if latest is not None and latest > start_time:
+            return latest + MATCH_WINDOW
+        return start_time + MATCH_WINDOW
+
+    def _has_adjacent(self, table: str, players: Players, start: int) -> bool:
+        row = self.connection.execute(
+                f'SELECT 1 FROM {table} WHERE player_a = ? AND player_b = ? '
+                'AND start_time > ? AND start_time < ? LIMIT 1',
+                (*players, start - ADJACENT_WINDOW, start + ADJACENT_WINDOW)).fetchone()
+        return row is not None
+
+    @perf.timed('database.add_match')
+    def add_match(self, players: Players,
+            start: datetime.datetime,
+            verbose: bool = False) -> bool:
+
+        players = self.registry.pair_names(self.registry.pair(players))
+        start_time = to_epoch(start)
+
+        if self._has_adjacent('results', players, start_time):
+            if verbose:
+                print('adjacent match')
+            return False
+
+        if self._has_adjacent('pending', players, start_time):
+            if verbose:
+                print('adjacent pending match')
+            return False
+
+        with self.connection:
+            self.connection.execute(
+                    'INSERT INTO pending (player_a, player_b, start_time, deadline) '
+                    'VALUES (?, ?, ?, ?)',
+                    (*players, start_time, self._deadline(start_time)))
+        return True
+
+    @perf.timed('database.add_results')
+    def add_results(self, #pylint: disable=too-many-arguments
+            players: Players,
+            end: datetime.datetime,
+            games: int,
+            division: str,
+            verbose: bool = False) -> bool:
+
+        players = self.registry.pair_names(self.registry.pair(players))
+        end_time = to_epoch(end)
+
+        with self.connection:
+            row = self.connection.execute(
+                    'SELECT rowid, start_time FROM pending '
+                    'WHERE player_a = ? AND player_b = ? AND start_time < ? '
+                    'ORDER BY start_time DESC LIMIT 1',
+                    (*players, end_time)).fetchone()
+            if row is None:
+                if verbose:
+                    print(f"No pending match between {players}")
+                return False
+
+            rowid, start_time = row
+            self.connection.execute('DELETE FROM pending WHERE rowid = ?', (rowid,))
+
+            if self._has_adjacent('results', players, start_time):
+                print(f'About to add duplicate match between {players} '
+                        f'at {from_epoch(start_time)}!')
+                return False
+
+            duration = end_time - start_time
+            avg = duration/games
+            if avg < 300 or avg > 7200:
+                print(f'Extreme average {avg} in {games}, skipping match between {players}')
+
+            latest = self._latest_result()
+            self.connection.execute(
+                    f'INSERT INTO results ({RESULT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)',
+                    (*players, start_time, duration, games, division))
+            # see Database.add_results, only an accepted result moves the clock
+            if latest is None or end_time > latest:
+                self.connection.execute('DELETE FROM pending WHERE deadline < ?',
+                        (end_time,))
+
+        self._changed(players)
+        if verbose:
+            print(f'Added match between {players}')
+        return True
+
+    def checkpoint(self, channel_id: int, message_id: int) -> None:
+        with self.connection:
+            self.connection.execute(
+                    'INSERT INTO checkpoints (channel_id, message_id) VALUES (?, ?) '
+                    'ON CONFLICT (channel_id) DO UPDATE SET message_id = excluded.message_id '
+                    'WHERE excluded.message_id > checkpoints.message_id',
+                    (channel_id, message_id))
+
+    @property
+    def checkpoints(self) -> Dict[int, int]:
+        return dict(self.connection.execute(
+            'SELECT channel_id, message_id FROM checkpoints'))
+
+    def add_alias(self, alias: str, name: str) -> None:
+        """See Database.add_alias."""
+        merges = self.registry.merges(alias, name)
+        self.registry.add_alias(alias, name)
+        with self.connection:
+            # a merge also moves the aliases of the merged player
+            self.connection.executemany(
+                    'INSERT OR REPLACE INTO aliases (alias, name) VALUES (?, ?)',
+                    self.registry.aliases.items() if merges
+                    else ((normalize(alias), self.registry.canonical(name)),))
+        if merges:
+            self.remap_players()
+        self.averages.clear()
+        self.reports.clear()
+
+    def remap_players(self) -> None:
+        """Rename the players of results and pending matches stored under an
+        alias to the player it's an alias of, after add_alias merged two
+        players."""
+        renamed = 0
+        with self.connection:
+            for table in ('pending', 'results'):
+                for alias in self.registry.aliases:
+                    rows = self.connection.execute(
+                            f'SELECT rowid, player_a, player_b FROM {table} WHERE player_a = ? '
+                            f'UNION ALL SELECT rowid, player_a, player_b FROM {table} '
+                            'WHERE player_b = ?', (alias, alias)).fetchall()
+                    self.connection.executemany(
+                            f'UPDATE {table} SET player_a = ?, player_b = ? WHERE rowid = ?',
+                            ((*self.registry.pair_names(self.registry.pair(players)), rowid)
+                                for rowid, *players in rows))
+                    renamed += len(rows)
+        if renamed:
+            self._changed()
+            self.averages.clear()
+            self.reports.clear()
+
+    def import_database(self, database: Database) -> None:
+        """Copy the pending matches and results of an in-memory Database."""
+        with self.connection:
+            self.connection.executemany(
+                    f'INSERT INTO results ({RESULT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)',
+                    ((*m.players, to_epoch(m.start_time), m.duration, m.game_count, m.division)
+                        for m in database.flat_matches))
+            # after the results, deadlines depend on the latest one
+            self.connection.executemany(
+                    'INSERT INTO pending (player_a, player_b, start_time, deadline) '
+                    'VALUES (?, ?, ?, ?)',
+                    ((*database.registry.pair_names(pair), to_epoch(start),
+                        self._deadline(to_epoch(start)))
+                        for pair, pending in database.pending_matches.items()
+                        for start in pending))
+            self.connection.executemany(
+                    'INSERT OR REPLACE INTO checkpoints (channel_id, message_id) VALUES (?, ?)',
+                    database.checkpoints.items())
+            self.connection.executemany(
+                    'INSERT OR REPLACE INTO aliases (alias, name) VALUES (?, ?)',
+                    database.registry.aliases.items())
+        for alias, name in database.registry.aliases.items():
+            self.registry.add_alias(alias, name)
+        self._changed()
+        self.reports.clear()
+
+    def matches_for(self, player: str) -> List[Result]:
+        player = self.registry.canonical(player)
+        rows = self.connection.execute(
+                f'SELECT {RESULT_COLUMNS} FROM results WHERE player_a = ? '
+                f'UNION ALL SELECT {RESULT_COLUMNS} FROM results WHERE player_b = ?',
+                (player, player))
+        return [_result(row) for row in rows]
+
+    def player_totals(self, player: str) -> Tuple[int, int]:
+        player = self.registry.canonical(player)
+        time, games = self.connection.execute(
+                'SELECT COALESCE(SUM(duration), 0), COALESCE(SUM(game_count), 0) FROM '
+                '(SELECT duration, game_count FROM results WHERE player_a = ? '
+                'UNION ALL SELECT duration, game_count FROM results WHERE player_b = ?)',
+                (player, player)).fetchone()
+        return time, games
+
+    @property
+    def flat_matches(self) -> List[Result]:
+        rows = self.connection.execute(
+                f'SELECT {RESULT_COLUMNS} FROM results ORDER BY rowid')
+        return [_result(row) for row in rows]
+
+    @property
+    def store(self) -> MatchStore:
+        """Columnar copy of all results for the bulk statistics, rebuilt when
+        results have been added since it was last used."""
+        if self._store is None or self._store_version != self.version:
+            self._store = MatchStore()
+            self._store.extend(self.flat_matches)
+            self._store_version = self.version
+        return self._store
+
+    def _extreme(self, order: str) -> Optional[Result]:
+        row = self.connection.execute(
+                f'SELECT {RESULT_COLUMNS} FROM results ORDER BY {order}, rowid LIMIT 1'
+                ).fetchone()
+        return None if row is None else _result(row)
+
+    @property
+    def aggregates(self) -> MatchAggregates:
+        if self._aggregates is not None and self._aggregates_version == self.version:
+            return self._aggregates
+
+        aggregates = MatchAggregates()
+        match_count, time, games, squares = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(duration), 0), COALESCE(SUM(game_count), 0), '
+                'COALESCE(SUM(CAST(duration AS REAL) * duration / game_count), 0) '
+                'FROM results').fetchone()
+        aggregates.match_count = match_count
+        aggregates.total.time = time
+        aggregates.total.games = games
+        aggregates.averages = WeightedStats.from_sums(games, time, squares)
+
+        for column, buckets in (('division', aggregates.divisions),
+                ('game_count', aggregates.game_counts)):
+            for key, bucket_time, bucket_games in self.connection.execute(
+                    f'SELECT {column}, SUM(duration), SUM(game_count) '
+                    f'FROM results GROUP BY {column}'):
+                bucket = Bucket()
+                bucket.time = bucket_time
+                bucket.games = bucket_games
+                buckets[key] = bucket
+
+        aggregates.longest = self._extreme('duration DESC')
+        aggregates.shortest = self._extreme('duration ASC')
+        aggregates.longest_average = self._extreme('CAST(duration AS REAL) / game_count DESC')
+        aggregates.shortest_average = self._extreme('CAST(duration AS REAL) / game_count ASC')
+
+        self._aggregates = aggregates
+        self._aggregates_version = self.version
+        return aggregates
+
+    def print_matches(self, data: str = 'all') -> None:
+        if data in ('all', 'matches'):
+            for row in self.connection.execute(
+                    f'SELECT {RESULT_COLUMNS} FROM results '
+                    'ORDER BY player_a, player_b, start_time'):
+                print(_result(row))
+        if data in ('all', 'pending'):
+            for player_a, player_b, start_time in self.connection.execute(
+                    'SELECT player_a, player_b, start_time FROM pending '
+                    'ORDER BY player_a, player_b, start_time'):
+                print((player_a, player_b), from_epoch(start_time))
+
+    @perf.timed('database.export_matches')
+    def export_matches(self, filename: str = 'matches.csv',
+            selection: Optional[ExportFilter] = None,
+            incremental: bool = False) -> int:
+        return export_csv(self.store, filename, selection, incremental)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @perf.timed('database.save')
+    def save(self) -> None:
+        """Every change is committed as it's made, this only folds the WAL
+        back into the database file."""
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    @perf.timed('database.load')
+    def load(self) -> None:
+        """The data is read from disk on demand, this only drops cached values
+        and renames players merged by an alias since they were stored."""
+        self.remap_players()
+        self._changed()
+        self.reports.clear()
+
+    def wipe(self, data: str = 'all') -> None:
+        with self.connection:
+            if data in ('all', 'pending'):
+                self.connection.execute('DELETE FROM pending')
+            if data in ('all', 'matches'):
+                self.connection.execute('DELETE FROM results')
+                self.connection.execute('DELETE FROM checkpoints')
+        self._changed()
+        self.reports.clear()
@@ -0,0 +1,178 @@
+"""Regression tests of weighted_stats against the statistics module on
+expanded lists, which is how the stdevs were computed before."""
+import datetime
+import random
+import statistics
+from typing import List, Tuple
+
+import numpy #type: ignore
+import pytest #type: ignore
+
+import game_statistics
+from aggregates import MatchAggregates
+from database import Database, open_database
+from weighted_stats import WeightedStats, weighted_mean_variance, weighted_stdev
+
+PAIRS: List[Tuple[float, int]] = [
+        (1500.0, 3), (1320.5, 1), (2010.25, 2), (987.0, 5), (1800.0, 1), (1234.5, 4)]
+
+
+def expand(pairs: List[Tuple[float, int]]) -> List[float]:
+    # the quadratic construction weighted_stats replaced
+    return sum(([value]*weight for value, weight in pairs), [])
+
+def random_pairs(seed: int, count: int = 200) -> List[Tuple[float, int]]:
+    rng = random.Random(seed)
+    return [(rng.randint(300, 5000) / rng.randint(1, 5), rng.randint(1, 5))
+            for _ in range(count)]
+
+
+def sums(pairs: List[Tuple[float, int]]) -> Tuple[int, float, float]:
+    return (sum(weight for _, weight in pairs),
+            sum(value * weight for value, weight in pairs),
+            sum(value * value * weight for value, weight in pairs))
+
+@pytest.mark.parametrize('pairs', [PAIRS, random_pairs(1), random_pairs(2)])
+def test_streaming(pairs: List[Tuple[float, int]]) -> None:
+    stats = WeightedStats()
+    stats.extend(pairs)
+    expanded = expand(pairs)
+    assert stats.weight == len(expanded)
+    assert stats.mean == pytest.approx(statistics.mean(expanded))
+    assert stats.stdev == pytest.approx(statistics.stdev(expanded))
+
+def test_add_one_at_a_time() -> None:
+    stats = WeightedStats()
+    for value, weight in PAIRS:
+        stats.add(value, weight)
+    assert stats.variance == pytest.approx(statistics.variance(expand(PAIRS)))
+
+@pytest.mark.parametrize('pairs', [PAIRS, random_pairs(3)])
+def test_from_sums(pairs: List[Tuple[float, int]]) -> None:
+    stats = WeightedStats.from_sums(*sums(pairs))
+    expanded = expand(pairs)
+    assert stats.mean == pytest.approx(statistics.mean(expanded))
+    assert stats.stdev == pytest.approx(statistics.stdev(expanded))
+
+@pytest.mark.parametrize('pairs', [PAIRS, random_pairs(4)])
+def test_vectorized(pairs: List[Tuple[float, int]]) -> None:
+    values = numpy.array([value for value, _ in pairs])
+    weights = numpy.array([weight for _, weight in pairs])
+    expanded = expand(pairs)
+    mean, variance = weighted_mean_variance(values, weights)
+    assert mean == pytest.approx(statistics.mean(expanded))
+    assert variance == pytest.approx(statistics.variance(expanded))
+    assert weighted_stdev(values, weights) == pytest.approx(statistics.stdev(expanded))
+
+@pytest.mark.parametrize('split', [0, 1, 3, 6])
+def test_merge(split: int) -> None:
+    first, second = WeightedStats(), WeightedStats()
+    first.extend(PAIRS[:split])
+    second.extend(PAIRS[split:])
+    first.merge(second)
+    expanded = expand(PAIRS)
+    assert first.weight == len(expanded)
+    assert first.mean == pytest.approx(statistics.mean(expanded))
+    assert first.stdev == pytest.approx(statistics.stdev(expanded))
+
+def test_merge_from_sums() -> None:
+    pairs = random_pairs(5)
+    stats = WeightedStats.from_sums(*sums(pairs[:120]))
+    stats.merge(WeightedStats.from_sums(*sums(pairs[120:])))
+    assert stats.stdev == pytest.approx(statistics.stdev(expand(pairs)))
+
+def test_from_sums_of_identical_values() -> None:
+    # cancellation in the sums must not make the variance negative
+    for value in (1000.1, 1234.567, 987.3):
+        stats = WeightedStats.from_sums(*sums([(value, 3), (value, 2)]))
+        assert 0.0 <= stats.variance == pytest.approx(0.0, abs=1e-6)
+
+def test_too_little_weight() -> None:
+    stats = WeightedStats()
+    with pytest.raises(statistics.StatisticsError):
+        _ = stats.variance
+    stats.add(1200.0, 1)
+    with pytest.raises(statistics.StatisticsError):
+        _ = stats.stdev
+    with pytest.raises(statistics.StatisticsError):
+        WeightedStats.from_sums(1, 1200.0, 1200.0**2).variance # pylint: disable=expression-not-assigned
+    with pytest.raises(statistics.StatisticsError):
+        weighted_mean_variance(numpy.array([1200.0]), numpy.array([1]))
+    with pytest.raises(statistics.StatisticsError):
+        weighted_stdev(numpy.array([], dtype=float), numpy.array([], dtype=int))
+
+def test_single_value_with_weight() -> None:
+    # one match of several games is several data points
+    stats = WeightedStats()
+    stats.add(1200.0, 2)
+    assert stats.stdev == 0.0
+
+def test_non_positive_weights_are_ignored() -> None:
+    stats = WeightedStats()
+    stats.extend([*PAIRS, (9999.0, 0), (5555.0, -2)])
+    assert stats.weight == len(expand(PAIRS))
+    assert stats.mean == pytest.approx(statistics.mean(expand(PAIRS)))
+    assert stats.stdev == pytest.approx(statistics.stdev(expand(PAIRS)))
+
+    empty = WeightedStats.from_sums(0, 0.0, 0.0)
+    assert (empty.weight, empty.mean) == (0, 0.0)
+    assert WeightedStats.from_sums(-3, 10.0, 100.0).weight == 0
+
+
+@pytest.fixture(name='database')
+def fixture_database(tmp_path) -> Database:
+    """A fixed history of 300 matches between 12 players."""
+    database = Database(str(tmp_path))
+    rng = random.Random(2021)
+    players = [f'player{i}' for i in range(12)]
+    start = datetime.datetime(2021, 3, 1)
+    for i in range(300):
+        pair = tuple(rng.sample(players, 2))
+        start_time = start + datetime.timedelta(hours=i)
+        game_count = rng.randint(1, 5)
+        duration = datetime.timedelta(seconds=rng.randint(600, 1800) * game_count)
+        database.add_match(pair, start_time)
+        database.add_results(pair, start_time + duration, game_count, 'A1')
+    return database
+
+def stdev_line(text: str) -> str:
+    return next(line for line in text.splitlines() if line.startswith('stdev:'))
+
+def test_main_stdev(database: Database, capsys) -> None:
+    expanded = expand([(m.duration/m.game_count, m.game_count)
+            for m in database.flat_matches])
+    game_statistics.main(database)
+    assert stdev_line(capsys.readouterr().out) == (
+            f'stdev: {statistics.stdev(expanded)/60:.2f}m')
+
+@pytest.mark.parametrize('player', ['player0', 'player5', 'player11'])
+def test_player_stats_stdev(database: Database, player: str) -> None:
+    expanded = expand([(m.duration/m.game_count, m.game_count)
+            for m in database.matches_for(player)])
+    report = game_statistics.player_stats(player, database)
+    assert stdev_line(report) == f'stdev: {statistics.stdev(expanded)/60:.2}m'
+    assert game_statistics.player_stdev(player, database) == pytest.approx(
+            statistics.stdev(expanded))
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_sharded_summary(tmp_path, backend: str) -> None:
+    # the shards' running aggregates merged, against the whole history at once
+    database = open_database(backend, str(tmp_path))
+    rng = random.Random(5)
+    players = [f'player{i}' for i in range(15)]
+    start = datetime.datetime(2022, 1, 1)
+    for i in range(400):
+        shard = database.shard(rng.choice([None, 1, 2, 3]))
+        pair = tuple(rng.sample(players, 2))
+        start_time = start + datetime.timedelta(hours=i)
+        game_count = rng.randint(1, 5)
+        duration = datetime.timedelta(seconds=rng.choice([900, 1200, 1500]) * game_count)
+        shard.add_match(pair, start_time)
+        shard.add_results(pair, start_time + duration, game_count, rng.choice(['A1', 'B2', 'C3']))
+    merged = database.aggregates
+    whole = MatchAggregates.from_store(database.store)
+    assert merged.averages.stdev == pytest.approx(whole.averages.stdev)
+    assert (merged.longest, merged.shortest) == (whole.longest, whole.shortest)
+    summary = game_statistics.summary(database)
+    database._aggregates = whole #pylint: disable=protected-access
+    assert summary == game_statistics.summary(database)
@@ -0,0 +1,80 @@
+"""Mean and variance of values weighted by integer counts.
+
+A match with an average game length `duration/game_count` counts once per game,
+so these give the same results as `statistics.mean`/`statistics.stdev` on a list
+with every average repeated `game_count` times, without building that list.
+"""
+from __future__ import annotations
+
+import math
+import statistics
+from typing import Iterable, Tuple
+
+import numpy #type: ignore
+
+
+class WeightedStats:
+    """Streaming weighted mean and sample variance, using West's update of
+    Welford's algorithm."""
+    def __init__(self) -> None:
+        self.weight = 0
+        self.mean = 0.0
+        self._sum_squares = 0.0
+
+    @classmethod
+    def from_sums(cls, weight: int, total: float, total_squares: float) -> WeightedStats:
+        """From the sums of weight, weight*value and weight*value**2."""
+        stats = cls()
+        if weight > 0:
+            stats.weight = weight
+            stats.mean = total / weight
+            stats._sum_squares = max(total_squares - total * stats.mean, 0.0)
+        return stats
+
+    def add(self, value: float, weight: int = 1) -> None:
+        if weight <= 0:
+            return
+        self.weight += weight
+        delta = value - self.mean
+        self.mean += delta * weight / self.weight
+        self._sum_squares += weight * delta * (value - self.mean)
+
+    def extend(self, pairs: Iterable[Tuple[float, int]]) -> None:
+        for value, weight in pairs:
+            self.add(value, weight)
+
+    def merge(self, other: WeightedStats) -> None:
+        """Add the values other has seen, with Chan et al.'s parallel update."""
+        if other.weight <= 0:
+            return
+        weight = self.weight + other.weight
+        delta = other.mean - self.mean
+        self.mean += delta * other.weight / weight
+        self._sum_squares += (other._sum_squares #pylint: disable=protected-access
+                + delta * delta * self.weight * other.weight / weight)
+        self.weight = weight
+
+    @property
+    def variance(self) -> float:
+        if self.weight < 2:
+            raise statistics.StatisticsError(
+                    'variance requires at least two data points')
+        return self._sum_squares / (self.weight - 1)
+
+    @property
+    def stdev(self) -> float:
+        return math.sqrt(self.variance)
+
+
+def weighted_mean_variance(values: numpy.ndarray, weights: numpy.ndarray
+        ) -> Tuple[float, float]:
+    total_weight = weights.sum()
+    if total_weight < 2:
+        raise statistics.StatisticsError(
+                'variance requires at least two data points')
+    mean = (values * weights).sum() / total_weight
+    variance = (weights * (values - mean)**2).sum() / (total_weight - 1)
+    return float(mean), float(variance)
+
+def weighted_stdev(values: numpy.ndarray, weights: numpy.ndarray) -> float:
+    return math.sqrt(weighted_mean_variance(values, weights)[1])
@@ -0,0 +1,187 @@
+"""Process pool for statistics that are too slow to run on the event loop.
+
+Workers don't get the database pickled with every job. The pool writes the
+results of each database, e.g. each shard, to a binary snapshot of its own
+whenever they've changed. Jobs only carry its path and a generation that's
+bumped on every write, and each worker memory maps it once per generation.
+"""
+import asyncio
+import concurrent.futures
+import cProfile
+import multiprocessing
+import os
+import tempfile
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from binary_snapshot import SnapshotDatabase, write_snapshot
+from export import ExportFilter, export_csv
+import charts
+import game_statistics
+import perf
+import profiler
+
+JOB_TIMEOUT = 30.0
+# exports grow with the whole history, unlike a single player's stats
+EXPORT_TIMEOUT = 15 * 60.0
+MAX_WORKERS = 2
+
+_snapshot: Optional[Tuple[str, int, SnapshotDatabase]] = None
+
+def _open_snapshot(path: str, generation: int) -> SnapshotDatabase:
+    global _snapshot #pylint: disable=global-statement
+    if _snapshot is None or _snapshot[:2] != (path, generation):
+        _snapshot = (path, generation, SnapshotDatabase(path))
+    return _snapshot[2]
+
+def _run_job(path: str, generation: int, #pylint: disable=too-many-arguments
+        function: Callable[..., Any], args: Tuple[Any, ...],
+        profile_dir: Optional[str] = None
+        ) -> Tuple[Any, Dict[str, perf.Histogram], Optional[str]]:
+    database = _open_snapshot(path, generation)
+    profile_file = None
+    if profile_dir is None:
+        result = function(*args, database=database)
+    else:
+        # the bot's profiler only sees the event loop waiting for this process,
+        # so the job is profiled here and the stats merged into its session
+        profile = cProfile.Profile()
+        result = profile.runcall(function, *args, database=database)
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_file = os.path.join(profile_dir,
+                f'worker-{os.getpid()}-{uuid.uuid4().hex}.pstats')
+        profile.dump_stats(profile_file)
+    # timings recorded in the worker are sent back to be merged in the bot
+    return result, perf.drain(), profile_file
+
+def player_stats_job(player: str, database: SnapshotDatabase) -> str:
+    return game_statistics.player_stats(player, database) # type: ignore
+
+def export_job(filename: str, selection: Optional[ExportFilter], incremental: bool,
+        database: SnapshotDatabase) -> int:
+    return export_csv(database.store, filename, selection, incremental)
+
+def chart_job(kind: str, argument: str, database: SnapshotDatabase) -> bytes:
+    return charts.render(kind, argument, database)
+
+
+class StatsPool:
+    def __init__(self, max_workers: int = MAX_WORKERS, timeout: float = JOB_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.snapshot_directory: Optional[str] = None
+        # id of each database -> its snapshot file, and the version and
+        # generation last written to it. Versions alone don't tell databases
+        # apart, shards all start out at the same one.
+        self._snapshots: Dict[int, Tuple[str, int, int]] = {}
+        self._generation = 0
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._snapshot_lock = asyncio.Lock()
+
+    def _pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            # forking a process with a running event loop and its threads isn't safe
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def _sync_snapshot(self, database: Any) -> Tuple[str, int]:
+        """Path and generation of the up to date snapshot of database."""
+        if self.snapshot_directory is None:
+            self.snapshot_directory = tempfile.mkdtemp(prefix='dominion_stats_')
+        async with self._snapshot_lock:
+            path, version, generation = self._snapshots.get(id(database), (
+                    os.path.join(self.snapshot_directory,
+                        f'results-{len(self._snapshots)}.snapshot'),
+                    -1, -1))
+            if version != database.version:
+                # writing and fsyncing the snapshot would block the event loop,
+                # so it happens on a thread, from a view taken at this version
+                version = database.version
+                store = database.store.view()
+                await asyncio.get_running_loop().run_in_executor(
+                        None, write_snapshot, store, path)
+                self._generation += 1
+                generation = self._generation
+                self._snapshots[id(database)] = (path, version, generation)
+        return path, generation
+
+    async def run(self, database: Any, function: Callable[..., Any], *args: Any,
+            timeout: Optional[float] = None) -> Any:
+        """Run function(*args, database=snapshot) in a worker process.
+
+        function must be a module level function so it can be pickled. Raises
+        asyncio.TimeoutError if it doesn't finish within timeout, by default
+        the pool's."""
+        profiled = profiler.session
+        with perf.timed(f'workers.{function.__name__}'):
+            result, timings, profile_file = await self._run(database, function, args,
+                    None if profiled is None else profiled.directory,
+                    self.timeout if timeout is None else timeout)
+        perf.merge(timings)
+        if profile_file is not None:
+            profiler.add_worker_profile(profiled, profile_file)
+        return result
+
+    async def _run(self, database: Any, function: Callable[..., Any], #pylint: disable=too-many-arguments
+            args: Tuple[Any, ...], profile_dir: Optional[str], timeout: float
+            ) -> Tuple[Any, Dict[str, perf.Histogram], Optional[str]]:
+        path, generation = await self._sync_snapshot(database)
+        future = self._pool().submit(_run_job, path, generation, function, args,
+                profile_dir)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if not future.cancel():
+                # already running, and a running job can't be interrupted; leave
+                # that worker to finish in the background on a retired pool
+                self.restart()
+            raise
+        except concurrent.futures.BrokenExecutor:
+            # a worker died, the executor can't run anything after that
+            self.restart()
+            raise
+
+    def restart(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+stats_pool = StatsPool()
+
+
+async def player_report(database: Any, player: str) -> str:
+    """The player_stats report of player, from the database's report cache
+    while none of the results it depends on have changed."""
+    report: Optional[str] = database.reports.get(player)
+    if report is None:
+        token = database.reports.token()
+        report = await stats_pool.run(database, player_stats_job, player)
+        database.reports.put(player, report,
+                game_statistics.report_dependencies(player, database), token)
+    return report
+
+async def refresh_reports(database: Any) -> int:
+    """Recompute the cached reports that new results have invalidated, so
+    players who were asked for recently don't have to wait for them."""
+    refreshed = 0
+    for player in database.reports.take_stale():
+        if player in database.reports:
+            continue
+        # one report failing mustn't stop the others from being refreshed
+        try:
+            await player_report(database, player)
+        except asyncio.TimeoutError:
+            print(f'Timed out refreshing the report of {player}')
+            continue
+        except Exception as error: #pylint: disable=broad-except
+            print(f'Failed refreshing the report of {player}: {error!r}')
+            continue
+        refreshed += 1
+    return refreshed